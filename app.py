@@ -1,12 +1,25 @@
 import streamlit as st
-import pandas as pd
-from supabase import create_client, Client
+from streamlit.errors import StreamlitAPIException
 from datetime import datetime, timedelta
 import os
-from streamlit_js_eval import get_geolocation
 import time
-from PIL import Image
 import io
+import threading
+import operator
+import re
+import tempfile
+import sqlite3
+import uuid
+import json
+import logging
+import zlib
+import math
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from backend import make_backend, OBSERVERS
+from archivio import Archive, TABLES as ARCHIVE_TABLES, compact as archive_compact
+# pandas/numpy si importano dopo il login, PIL, pydeck, pyarrow e streamlit_js_eval nelle
+# funzioni che li usano: la schermata di accesso di un processo appena avviato non li carica
 
 # ==============================================================================
 # 1. CONFIGURAZIONE E STILE (VERDE ORIGINALE + FIX MOBILE)
@@ -18,139 +31,1391 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# CSS ORIGINALE (VERDE) CON AGGIUNTE PER MOBILE
-st.markdown("""
-    <style>
-    .stApp { background-color: #f4f6f9; font-family: 'Segoe UI', sans-serif; }
-    
-    /* Stile Blocchi Originale */
-    div.stBlock {
-        background-color: #ffffff; padding: 25px; border-radius: 12px; 
-        border: 1px solid #e0e0e0; border-top: 5px solid #2e7d32; 
-        box-shadow: 0 4px 10px rgba(0,0,0,0.05); margin-bottom: 20px;
-    }
-    
-    /* Bottoni Verdi Originali */
-    .stButton>button {
-        background-color: #2e7d32; color: white; border: none; padding: 12px; 
-        border-radius: 8px; font-weight: 600; width: 100%; transition: all 0.3s ease;
-    }
-    .stButton>button:hover { background-color: #1b5e20; transform: translateY(-2px); box-shadow: 0 4px 8px rgba(0,0,0,0.1); }
-    
-    /* Mappe */
-    [data-testid="stMap"] { height: 350px !important; border-radius: 10px; border: 1px solid #ccc; }
-    
-    /* Bacheca Card Originale */
-    .bacheca-card {
-        background-color: #fffde7; border-left: 8px solid #fbc02d; padding: 15px;
-        border-radius: 8px; margin-bottom: 15px; box-shadow: 0 2px 5px rgba(0,0,0,0.05);
-    }
-    .bacheca-title { font-weight: 900; font-size: 18px; color: #f57f17; display: block; }
-    .bacheca-meta { font-size: 12px; color: #777; margin-top: 5px; font-style: italic; }
-    
-    /* Card Issues Originale */
-    .issue-card {
-        border-left: 5px solid #d32f2f; background-color: #fff; padding: 15px;
-        margin-bottom: 10px; border-radius: 8px; border: 1px solid #eee;
-    }
-    
-    /* Card Richieste Originale */
-    .req-card {
-        border-left: 5px solid #1976d2; background-color: #e3f2fd; padding: 15px;
-        margin-bottom: 10px; border-radius: 8px; border: 1px solid #bbdefb;
-    }
-    
-    /* Tabelle Originali */
-    .report-table { width: 100%; border-collapse: collapse; margin-top: 10px; }
-    .report-table th { background-color: #e8f5e9; padding: 10px; text-align: left; border-bottom: 2px solid #2e7d32; }
-    .report-table td { padding: 10px; border-bottom: 1px solid #eee; }
-    
-    /* Sidebar Bianca */
-    section[data-testid="stSidebar"] { background-color: #ffffff; border-right: 1px solid #e0e0e0; }
+# CSS ORIGINALE (VERDE) CON AGGIUNTE PER MOBILE: in static/chemifol.css, servito come
+# file statico (.streamlit/config.toml) e tenuto in cache dal browser; a ogni rerun
+# parte solo il link. Logo in static/logo.png, cercato una volta per processo.
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+st.markdown("<link rel='stylesheet' href='app/static/chemifol.css'>", unsafe_allow_html=True)
 
-    /* --- AGGIUNTE PER ORDINE MOBILE --- */
-    /* Centratura Tabelle */
-    .stDataFrame, .stTable { width: 100% !important; display: flex; justify-content: center; }
-    
-    /* Link Maps Bello */
-    .map-link {
-        display: block; text-align: center; background-color: #e8f5e9;
-        padding: 8px; border-radius: 6px; color: #2e7d32;
-        text-decoration: none; font-weight: bold; margin-top: 5px; border: 1px solid #c8e6c9;
-    }
-    
-    /* Mobile Responsive */
-    @media only screen and (max-width: 600px) {
-        .stDataFrame { font-size: 12px; }
-        h1 { text-align: center; font-size: 24px !important; color: #2e7d32 !important; }
-        div.stBlock { padding: 15px; }
-    }
-    </style>
-    """, unsafe_allow_html=True)
+@st.cache_resource
+def logo_src():
+    if os.path.exists(os.path.join(STATIC_DIR, "logo.png")): return "app/static/logo.png"
+    return "logo.png" if os.path.exists("logo.png") else None  # vecchia posizione, letto da st.image
+
+def show_logo(width):
+    src = logo_src()
+    if src is None: return False
+    if src.startswith("app/"): st.markdown(f"<img src='{src}' width='{width}'>", unsafe_allow_html=True)
+    else: st.image(src, width=width)
+    return True
 
 # ==============================================================================
-# 2. CONNESSIONE SUPABASE E FUNZIONI
+# 2. CONNESSIONE DATI E FUNZIONI
 # ==============================================================================
+# Backend dati (vedi backend.py): Supabase di default, SQLite locale con [backend] nei secrets
 @st.cache_resource
 def init_connection():
     try:
-        url = st.secrets["supabase"]["url"]
-        key = st.secrets["supabase"]["key"]
-        return create_client(url, key)
+        conf = dict(st.secrets.get("backend", {}))
+        if conf.get("type", "supabase") == "supabase":
+            conf = {"type": "supabase", "url": st.secrets["supabase"]["url"], "key": st.secrets["supabase"]["key"]}
+        return make_backend(conf)
     except:
         st.error("⚠️ Configura i Secrets su Streamlit!")
         return None
 
-supabase = init_connection()
+db = init_connection()
+
+# ------------------------------------------------------------------------------
+# TRACCIA DEL RERUN
+# Ogni rerun registra le chiamate get_df (sorgente mirror/cache, "+db" se ha
+# dovuto leggere), le chiamate al backend fatte dal thread dello script e il
+# tempo delle sezioni della pagina. Il rerun precedente interrotto da
+# st.rerun()/st.stop() viene chiuso all'inizio del successivo.
+# Riga JSON nel log per rerun con CHEMIFOL_TRACE_LOG=1, e una per ogni chiamata
+# fatta fuori da un rerun (upload delle foto, invio delle timbrature in coda).
+# ------------------------------------------------------------------------------
+TRACE_LOG = os.environ.get("CHEMIFOL_TRACE_LOG") == "1"
+TRACE_MAX_CALLS = 500
+# Uno per processo: ogni rerun esegue lo script in un modulo nuovo, e l'observer
+# installato da get_page_stats deve vedere la stessa thread-local di trace_begin
+@st.cache_resource
+def _get_trace_local():
+    return threading.local()
+
+_trace_local = _get_trace_local()
+
+class Trace:
+    def __init__(self, session):
+        self.session, self.page, self.started = session, None, datetime.now().isoformat(timespec="seconds")
+        self.t0 = time.perf_counter()
+        self.calls, self.sections, self.total_ms, self.done = [], [], None, False
+        self._sec = ("avvio", 0.0)
+
+    def ms(self):
+        return (time.perf_counter() - self.t0) * 1000
+
+    def add(self, ev):
+        if len(self.calls) < TRACE_MAX_CALLS: self.calls.append(ev)
+
+    # Chiude la sezione corrente e ne apre un'altra (None = nessuna)
+    def section(self, name):
+        now = self.ms()
+        if self._sec: self.sections.append({"sezione": self._sec[0], "ms": round(now - self._sec[1], 1)})
+        self._sec = (name, now) if name else None
+
+    def to_dict(self):
+        db_calls = [c for c in self.calls if c["kind"] == "db"]
+        return {"session": self.session, "page": self.page, "started": self.started, "total_ms": self.total_ms,
+                "db_calls": len(db_calls), "db_rows": sum(c["rows"] for c in db_calls), "db_bytes": sum(c["bytes"] for c in db_calls),
+                "sections": self.sections, "calls": self.calls}
+
+# Statistiche per pagina condivise dal processo: conteggio, media, p95 e massimo
+class PageStats:
+    def __init__(self, keep=200):
+        self.lock, self.keep, self.pages = threading.Lock(), keep, {}
+
+    def record(self, page, ms):
+        with self.lock: self.pages.setdefault(page, deque(maxlen=self.keep)).append(ms)
+
+    def slowest(self, n=10):
+        with self.lock: items = [(p, sorted(v)) for p, v in self.pages.items()]
+        rows = [{"pagina": p, "rerun": len(v), "media_ms": round(sum(v) / len(v)), "p95_ms": round(v[int(0.95 * (len(v) - 1))]),
+                 "max_ms": round(v[-1])} for p, v in items]
+        return sorted(rows, key=lambda r: -r["p95_ms"])[:n]
+
+# Installato una volta per processo: le chiamate al backend finiscono nella traccia del thread che le fa
+@st.cache_resource
+def get_page_stats():
+    def on_call(ev):
+        tr = getattr(_trace_local, "trace", None)
+        call = {"kind": "db", "op": ev["op"], "table": ev["table"], "filters": str(ev["filters"])[:200], "rows": ev["rows"],
+                "bytes": ev["bytes"], "ms": round(ev["ms"], 1), "src": ev["error"] or ""}
+        if tr is not None: tr.add(call)
+        elif TRACE_LOG:
+            call.update(thread=threading.current_thread().name, at=datetime.now().isoformat(timespec="milliseconds"))
+            logging.getLogger("chemifol.trace").info(json.dumps(call, default=str, ensure_ascii=False))
+    # I byte solo per una traccia attiva (o per il log): senza, nessun json.dumps dei risultati
+    on_call.wants_bytes = lambda: TRACE_LOG or getattr(_trace_local, "trace", None) is not None
+    OBSERVERS.append(on_call)
+    if TRACE_LOG:
+        log = logging.getLogger("chemifol.trace")
+        h = logging.StreamHandler(); h.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(h); log.setLevel(logging.INFO); log.propagate = False
+    return PageStats()
+
+def trace_begin():
+    prev = st.session_state.get("trace")
+    if prev is not None and not prev.done: trace_end(prev)
+    tr = Trace(st.session_state.setdefault("trace_session", os.urandom(4).hex()))
+    st.session_state.trace = _trace_local.trace = tr
+    return tr
+
+def trace_end(tr):
+    if tr.done: return tr
+    tr.section(None); tr.total_ms, tr.done = round(tr.ms(), 1), True
+    if getattr(_trace_local, "trace", None) is tr: _trace_local.trace = None
+    get_page_stats().record(tr.page or "login", tr.total_ms)
+    if TRACE_LOG: logging.getLogger("chemifol.trace").info(json.dumps(tr.to_dict(), default=str, ensure_ascii=False))
+    return tr
+
+def trace_section(name):
+    tr = getattr(_trace_local, "trace", None)
+    if tr is not None: tr.section(name)
+
+def trace_call(op, table_name, filters, rows, ms, src):
+    tr = getattr(_trace_local, "trace", None)
+    if tr is not None:
+        if threading.current_thread().name.startswith("prefetch"): src = "prefetch:" + src
+        tr.add({"kind": "app", "op": op, "table": table_name, "filters": str(filters or [])[:200], "rows": rows,
+                "bytes": 0, "ms": round(ms, 1), "src": src})
+
+# Pannello debug (solo admin): ultimo rerun, chiamate ripetute, pagine più lente del processo
+def trace_panel(slot, tr):
+    with slot.container():
+        with st.expander("🛠️ Debug"):
+            d = tr.to_dict()
+            st.caption(f"{d['page']} · {d['total_ms']:.0f} ms · {d['db_calls']} chiamate db · {d['db_rows']} righe · {d['db_bytes'] // 1024} KB")
+            if d["sections"]: st.dataframe(pd.DataFrame(d["sections"]), hide_index=True, use_container_width=True)
+            if d["calls"]:
+                calls = pd.DataFrame(d["calls"])
+                st.dataframe(calls[["kind", "op", "table", "rows", "ms", "src", "filters"]], hide_index=True, use_container_width=True)
+                # Il prefetch legge apposta ciò che la pagina rileggerà dalla cache: non è una ripetizione
+                rep = calls[~calls["src"].str.startswith("prefetch")].groupby(["kind", "op", "table", "filters"]).size()
+                for (k, o, t, f), n in rep[rep > 1].items(): st.warning(f"{o} {t} ×{n} ({k}) {f}")
+            st.download_button("Esporta traccia (JSON)", json.dumps(d, default=str, indent=1, ensure_ascii=False), file_name=f"trace_{d['started']}.json",
+                               mime="application/json", on_click="ignore")
+            st.markdown("**Pagine più lente (processo)**")
+            st.dataframe(pd.DataFrame(get_page_stats().slowest()), hide_index=True, use_container_width=True)
+
+# Filtri: lista di tuple (operatore, colonna, valore), es. ("eq", "username", u).
+# Operatori: eq, neq, gt, gte, lt, lte, in_, is_, not_is, ov, keyset_lt, keyset_gt (backend.py).
+def _order(order):
+    return [order] if isinstance(order, str) else list(order or [])
+
+# Cache di processo condivisa da tutte le sessioni, chiave (tabella, query).
+# TTL breve + eviction LRU; richieste identiche concorrenti aspettano l'unica
+# fetch in volo. Le scritture dell'app invalidano subito la tabella toccata.
+CACHE_TTL = 20
+CACHE_MAX_ENTRIES = 256
+
+class TableCache:
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl, self.max_entries = ttl, max_entries
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # chiave -> (scadenza, valore)
+        self._inflight = {}         # chiave -> Event della fetch in corso
+        self._gen = {}              # tabella -> contatore invalidazioni
+
+    def get(self, key, loader, ttl=None):
+        table = key[0]
+        while True:
+            with self._lock:
+                hit = self._data.get(key)
+                if hit and hit[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    return hit[1]
+                ev = self._inflight.get(key)
+                if ev is None:
+                    ev = self._inflight[key] = threading.Event()
+                    gen = self._gen.get(table, 0)
+                    break
+            # Un'altra sessione sta già scaricando: aspetto e rileggo dalla cache
+            ev.wait()
+        try:
+            value = loader()
+            with self._lock:
+                # Se nel frattempo c'è stata una scrittura il risultato è vecchio: non lo salvo
+                if self._gen.get(table, 0) == gen:
+                    self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+                    self._data.move_to_end(key)
+                    while len(self._data) > self.max_entries: self._data.popitem(last=False)
+            return value
+        finally:
+            with self._lock: self._inflight.pop(key, None)
+            ev.set()
+
+    def invalidate(self, table_name):
+        with self._lock:
+            self._gen[table_name] = self._gen.get(table_name, 0) + 1
+            for k in [k for k in self._data if k[0] == table_name]: del self._data[k]
+
+@st.cache_resource
+def get_cache():
+    return TableCache()
+
+def _query_key(table_name, cols, filters, order, desc, limit):
+    flt = tuple((op, col, tuple(val) if isinstance(val, list) else val) for op, col, val in filters or [])
+    return (table_name, cols, flt, tuple(_order(order)), desc, limit)
+
+def _fetch(table_name, cols, filters, order, desc, limit):
+    rows, _ = db.select(table_name, cols, filters, _order(order), desc, limit)
+    return pd.DataFrame(rows)
+
+# Stessi filtri del backend valutati in pandas (NULL escluso come in SQL)
+_OPS = {"eq": operator.eq, "neq": operator.ne, "gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+
+def _filter_df(df, filters):
+    mask = pd.Series(True, index=df.index)
+    for op, col, val in filters or []:
+        s = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if op == "is_": mask &= s.isna()
+        elif op == "not_is": mask &= s.notna()
+        elif op == "in_": mask &= s.isin(list(val))
+        elif op == "ov":
+            vals = set(val)
+            mask &= s.map(lambda a: isinstance(a, (list, tuple)) and not vals.isdisjoint(a)).astype(bool)
+        elif op in ("keyset_lt", "keyset_gt"):
+            o, (v, i) = _OPS[op[-2:]], val
+            s = s.astype(str) if isinstance(v, str) else s
+            mask &= s.notna() & (o(s, v) | ((s == v) & o(df['id'], i)))
+        else: mask &= s.notna() & _OPS[op](s.astype(str) if isinstance(val, str) else s, val)
+    return df[mask]
+
+# ------------------------------------------------------------------------------
+# Copia locale (per processo) delle tabelle che crescono: al refresh scarico solo
+# le righe con updated_at oltre l'ultimo watermark e le fondo per id. Le
+# cancellazioni fatte da fuori si recuperano con una riconciliazione periodica degli id.
+# ------------------------------------------------------------------------------
+SYNC_TABLES = ("logs", "issues", "material_requests")
+SYNC_INTERVAL = 5      # secondi minimi tra due delta
+SYNC_RECONCILE = 300   # secondi tra due riconciliazioni delle cancellazioni
+SYNC_OVERLAP = timedelta(seconds=5)  # margine per commit arrivati in ritardo
+SYNC_PAGE = 1000       # righe per richiesta (max-rows di PostgREST)
+
+class TableMirror:
+    def __init__(self, table_name):
+        self.table = table_name
+        self.df = pd.DataFrame()
+        self.watermark = None
+        self.dirty = True
+        self.last_delta = 0.0
+        self.last_reconcile = 0.0
+        self.version = 0  # cresce a ogni cambio dei dati: chiave per i calcoli derivati
+        self._lock = threading.Lock()
+
+    # Scarico paginato per id, così non mi fermo al limite di righe del server
+    def _pull(self, cols="*", filters=()):
+        rows, last_id = [], None
+        while True:
+            flt = list(filters) + ([("gt", "id", last_id)] if last_id is not None else [])
+            page, _ = db.select(self.table, cols, flt, ["id"], limit=SYNC_PAGE)
+            rows += page
+            if len(page) < SYNC_PAGE: return pd.DataFrame(rows)
+            last_id = page[-1]['id']
+
+    def refresh(self):
+        with self._lock:
+            now = time.monotonic()
+            if not self.dirty and now - self.last_delta < SYNC_INTERVAL: return self.df
+            try:
+                if self.watermark is None:
+                    # Primo giro (o tabella senza updated_at): copia completa
+                    self.df = self._pull()
+                    self.last_reconcile = now
+                    self.version += 1
+                else:
+                    since = (pd.Timestamp(self.watermark) - SYNC_OVERLAP).isoformat()
+                    delta = self._pull(filters=[("gte", "updated_at", since)])
+                    # Le righe della finestra di sovrapposizione tornano a ogni giro: conto solo quelle cambiate
+                    if not delta.empty and not self.df.empty:
+                        delta = delta[delta['updated_at'].ne(delta['id'].map(self.df.set_index('id')['updated_at']))]
+                    if not delta.empty:
+                        self.df = pd.concat([self.df[~self.df['id'].isin(delta['id'])], delta], ignore_index=True)
+                        self.version += 1
+                    if now - self.last_reconcile > SYNC_RECONCILE:
+                        ids = self._pull("id")
+                        if not self.df.empty: self.df = self.df[self.df['id'].isin(ids['id'] if not ids.empty else [])].reset_index(drop=True)
+                        self.last_reconcile = now
+                        self.version += 1
+                if 'updated_at' in self.df.columns and self.df['updated_at'].notna().any():
+                    self.watermark = self.df['updated_at'].max()
+                self.dirty, self.last_delta = False, now
+            except:
+                # Server irraggiungibile: se ho già una copia la servo com'è
+                if self.df.empty and self.watermark is None: raise
+            return self.df
+
+    # Le mie cancellazioni le applico subito (il delta non vede righe sparite)
+    def drop(self, filters):
+        with self._lock:
+            if not self.df.empty: self.df = self.df.drop(_filter_df(self.df, filters).index).reset_index(drop=True)
+            self.dirty = True
+            self.version += 1
+
+@st.cache_resource
+def get_mirror(table_name):
+    return TableMirror(table_name)
+
+def _query_mirror(table_name, cols, filters, order, desc, limit):
+    df = _filter_df(get_mirror(table_name).refresh(), filters)
+    orders = _order(order)
+    if orders and not df.empty: df = df.sort_values(orders, ascending=not desc)
+    if limit: df = df.head(limit)
+    if cols != "*": df = df.reindex(columns=[c.strip() for c in cols.split(",")])
+    return df.reset_index(drop=True)
+
+def get_df(table_name, cols="*", filters=None, order=None, desc=False, limit=None):
+    if not db: return pd.DataFrame()
+    tr = getattr(_trace_local, "trace", None)
+    t0, n0 = time.perf_counter(), len(tr.calls) if tr else 0
+    src = "mirror" if table_name in SYNC_TABLES else "cache"
+    try:
+        if src == "mirror": df = _query_mirror(table_name, cols, filters, order, desc, limit)
+        else:
+            key = _query_key(table_name, cols, filters, order, desc, limit)
+            df = get_cache().get(key, lambda: _fetch(table_name, cols, filters, order, desc, limit)).copy()
+    except:
+        df, src = pd.DataFrame(), "errore"
+    if tr:
+        if len(tr.calls) > n0: src += "+db"
+        trace_call("get_df", table_name, filters, len(df), (time.perf_counter() - t0) * 1000, src)
+    return df
+
+# Conteggio senza scaricare righe (count=exact, head=True)
+def count_rows(table_name, filters=None):
+    if not db: return 0
+    try:
+        key = _query_key(table_name, "count", filters, None, False, None)
+        return get_cache().get(key, lambda: db.select(table_name, "id", filters, count=True, head=True)[1] or 0)
+    except:
+        return 0
 
-# Funzione Excel
-def to_excel(df):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Report')
-    return output.getvalue()
+# Da leggere: "visto" = 0. Conteggi senza righe, in cache per pochi secondi.
+def unread_count(table_name):
+    return count_rows(table_name, [("eq", "visto", 0)])
 
-def get_df(table_name):
-    if not supabase: return pd.DataFrame()
+# Segna come visti solo gli id effettivamente mostrati, una volta per sessione:
+# le interazioni successive sulla stessa pagina non riscrivono nulla.
+def mark_seen(table_name, df):
+    if df.empty or 'visto' not in df.columns: return
+    seen = st.session_state.setdefault('seen_ids', set())
+    ids = [int(i) for i in df.loc[df['visto'] == 0, 'id'] if (table_name, int(i)) not in seen]
+    if not ids: return
     try:
-        response = supabase.table(table_name).select("*").execute()
-        return pd.DataFrame(response.data)
+        db_update(table_name, {"visto": 1}, [("in_", "id", ids), ("eq", "visto", 0)])
+        seen.update((table_name, i) for i in ids)
+    except: pass
+
+# ------------------------------------------------------------------------------
+# Paginazione keyset lato server: pagine ordinate per (order_col, id) decrescente,
+# il cursore è la coppia (valore, id) della prima/ultima riga mostrata. Va sempre
+# al server (non alla copia locale) e ogni pagina costa PAGE_SIZE righe; le righe
+# dell'archivio freddo con lo stesso filtro keyset si fondono nella pagina.
+# ------------------------------------------------------------------------------
+PAGE_SIZE = 20
+
+def get_page(table_name, cols, filters, order_col, cursor=None, back=False, page_size=PAGE_SIZE):
+    if not db: return pd.DataFrame()
+    flt = list(filters or [])
+    if cursor: flt.append(("keyset_gt" if back else "keyset_lt", order_col, tuple(cursor)))
+    try:
+        key = _query_key(table_name, cols, flt, [order_col, "id"], not back, page_size)
+        df = get_cache().get(key, lambda: _fetch(table_name, cols, flt, [order_col, "id"], not back, page_size))
     except:
         return pd.DataFrame()
+    old = cold_page(table_name, cols, flt, order_col, back, page_size)
+    if not old.empty:
+        if 'id' in df.columns: old = old[~old['id'].isin(df['id'])]
+        df = pd.concat([x for x in (df, old) if not x.empty], ignore_index=True)
+        df = df.sort_values([order_col, "id"], ascending=back).head(page_size).reset_index(drop=True)
+    return df.iloc[::-1].reset_index(drop=True) if back else df.copy()
+
+# Pagina corrente + pulsanti avanti/indietro; lo stato resta in sessione per vista
+def pager(name, table_name, cols, filters, order_col):
+    state = st.session_state.setdefault(f"pg_{name}", {"cursor": None, "back": False, "n": 0})
+    total = count_rows(table_name, filters) + cold_count(table_name, filters)
+    df = get_page(table_name, cols, filters, order_col, state["cursor"], state["back"])
+    if df.empty and state["n"] > 0:
+        state.update(cursor=None, back=False, n=0); st.rerun()
+    pages = max(1, -(-total // PAGE_SIZE))
+    c_prev, c_info, c_next = st.columns([1, 2, 1])
+    c_info.caption(f"Pagina {state['n'] + 1} di {pages} · {total} totali")
+    if c_prev.button("◀ Precedenti", key=f"pg_prev_{name}", disabled=state["n"] == 0):
+        if state["n"] == 1: state.update(cursor=None, back=False, n=0)
+        else: state.update(cursor=(df[order_col].iloc[0], int(df['id'].iloc[0])), back=True, n=state["n"] - 1)
+        st.rerun()
+    if c_next.button("Successivi ▶", key=f"pg_next_{name}", disabled=state["n"] + 1 >= pages):
+        state.update(cursor=(df[order_col].iloc[-1], int(df['id'].iloc[-1])), back=False, n=state["n"] + 1)
+        st.rerun()
+    return df
+
+# Scritture: passano tutte di qui per invalidare la cache della tabella.
+# Update/delete che non toccano righe (es. nessun "visto" da segnare) non invalidano.
+def _invalidate(table_name):
+    get_cache().invalidate(table_name)
+    if table_name in REF_TABLES: get_ref_holder().invalidate()
+    if table_name in SYNC_TABLES: get_mirror(table_name).dirty = True
 
-def upload_photo(file):
-    if not file or not supabase: return None
+def _write(table_name, run):
     try:
-        file_name = f"{int(time.time())}_{file.name}"
-        file_bytes = file.getvalue()
-        supabase.storage.from_("foto_cantieri").upload(file_name, file_bytes, {"content-type": file.type})
-        return supabase.storage.from_("foto_cantieri").get_public_url(file_name)
+        data = run()
     except:
-        return None
+        _invalidate(table_name); raise
+    if data: _invalidate(table_name)
+    return data
+
+def db_insert(table_name, rows):
+    return _write(table_name, lambda: db.insert(table_name, rows))
+
+def db_update(table_name, values, filters):
+    return _write(table_name, lambda: db.update(table_name, values, filters))
+
+def db_delete(table_name, filters):
+    data = _write(table_name, lambda: db.delete(table_name, filters))
+    if data and table_name in SYNC_TABLES: get_mirror(table_name).drop(filters)
+    return data
+
+def db_upsert(table_name, rows, on_conflict):
+    return _write(table_name, lambda: db.upsert(table_name, rows, on_conflict))
+
+# Intervalli temporali [inizio, fine) in ISO per i filtri su start_time
+def day_bounds(d):
+    t0 = datetime(d.year, d.month, d.day)
+    return t0.isoformat(), (t0 + timedelta(days=1)).isoformat()
+
+def month_bounds(mese):
+    m, y = [int(x) for x in mese.split("-")]
+    t1 = datetime(y + 1, 1, 1) if m == 12 else datetime(y, m + 1, 1)
+    return datetime(y, m, 1).isoformat(), t1.isoformat()
+
+# "Adesso" al minuto: i filtri sul tempo restano uguali tra un rerun e l'altro e la cache li riconosce
+def now_minute():
+    return datetime.now().replace(second=0, microsecond=0).isoformat()
+
+# Date ISO così come arrivano dal database (con o senza microsecondi)
+def to_dt(s):
+    return pd.to_datetime(s, format="ISO8601")
+
+# Mesi (mm-YYYY) dal primo giorno lavorato ad oggi, il più recente per primo
+def month_options():
+    df = get_df(ROLLUP_TABLE, "giorno", order="giorno", limit=1)
+    if df.empty: df = get_df("logs", "start_time", order="start_time", limit=1).rename(columns={"start_time": "giorno"})
+    if df.empty: return []
+    first = pd.to_datetime(df['giorno'].iloc[0])
+    return [p.strftime('%m-%Y') for p in pd.period_range(first, datetime.now(), freq='M')][::-1]
+
+# Ore di ogni turno chiuso, arrotondate al centesimo come nel report
+def shift_hours(df):
+    return ((to_dt(df['end_time']) - to_dt(df['start_time'])).dt.total_seconds() / 3600).round(2)
+
+# ------------------------------------------------------------------------------
+# ARCHIVIO FREDDO: i mesi chiusi che archivio.py ha tolto da logs, issues e
+# material_requests, in Parquet per mese. get_history unisce righe vive e
+# archiviate (per id vince la viva): chi legge lo storico non sa dove stanno.
+# Si aprono solo i mesi toccati dal filtro sulla data; i file cambiano solo con
+# compattazioni ed eliminazioni, quindi stanno in una cache a parte, con chiave la
+# versione dell'archivio: le scritture sulle tabelle vive non la svuotano.
+# ------------------------------------------------------------------------------
+ARCHIVE_TTL = 600
+
+@st.cache_resource
+def get_cold_cache():
+    return TableCache(ttl=ARCHIVE_TTL)
+
+@st.cache_resource
+def get_archive():
+    try: conf = dict(st.secrets.get("archivio", {}))
+    except: conf = {}
+    path = conf.get("dir", "archivio")
+    if not conf and not os.path.isdir(path): return None
+    return Archive(path, db, conf.get("bucket"), bool(conf.get("durevole")))
+
+# Mesi archiviati che il filtro può toccare: intervallo sulla colonna data e,
+# per le ricerche per id, solo i mesi con id_min..id_max che li contiene (indice.json)
+def _cold_months(arch, table_name, filters):
+    col, lo, hi, ids = ARCHIVE_TABLES[table_name]["time"], None, None, None
+    for op, c, val in filters or []:
+        if c == "id" and op in ("eq", "in_"):
+            v = {int(x) for x in (val if op == "in_" else [val])}
+            ids = v if ids is None else ids & v
+        if c != col: continue
+        if op == "keyset_lt": op, val = "lt", val[0]
+        elif op == "keyset_gt": op, val = "gt", val[0]
+        if op in ("eq", "gt", "gte"): lo = max(lo, str(val)) if lo else str(val)
+        if op in ("eq", "lt", "lte"): hi = min(hi, str(val)) if hi else str(val)
+    return tuple(arch.months(table_name, lo, hi, ids))
+
+def _cold_archive(table_name):
+    return get_archive() if db and table_name in ARCHIVE_TABLES else None
+
+# Righe archiviate che soddisfano i filtri (stessa semantica di get_df, senza ordine);
+# months limita la lettura a quei mesi (già scelti da _cold_months)
+def cold_df(table_name, cols, filters, months=None):
+    arch = _cold_archive(table_name)
+    if arch is None: return pd.DataFrame()
+    t0 = time.perf_counter()
+    try:
+        if months is None: months = _cold_months(arch, table_name, filters)
+        if not months: return pd.DataFrame()
+        want = None if cols == "*" else [c.strip() for c in cols.split(",")]
+        need = None if want is None else sorted(set(want) | {c for _, c, _ in filters or []} | {"id"})
+        key = (table_name, archive_version(table_name), cols, _query_key(table_name, cols, filters, None, False, None)[2], months)
+        df = get_cold_cache().get(key, lambda: _filter_df(arch.read(table_name, need, filters, months), filters))
+        df = df.reset_index(drop=True) if want is None else df.reindex(columns=want).reset_index(drop=True)
+    except:
+        df = pd.DataFrame()
+    trace_call("cold_df", table_name, filters, len(df), (time.perf_counter() - t0) * 1000, "archivio")
+    return df
+
+# Righe per la pagina keyset: un mese alla volta dal più vicino al cursore, fermandosi
+# appena ce ne sono page_size (i mesi più lontani non possono entrare nella pagina)
+def cold_page(table_name, cols, filters, order_col, back, page_size):
+    arch = _cold_archive(table_name)
+    if arch is None: return pd.DataFrame()
+    try: months = _cold_months(arch, table_name, filters)
+    except: return pd.DataFrame()
+    if order_col != ARCHIVE_TABLES[table_name]["time"]: return cold_df(table_name, cols, filters, months)
+    parts, n = [], 0
+    for m in months if back else months[::-1]:
+        df = cold_df(table_name, cols, filters, (m,))
+        if not df.empty: parts.append(df); n += len(df)
+        if n >= page_size: break
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+# Righe archiviate che soddisfano i filtri: dai conteggi di indice.json quando i filtri
+# sono la condizione di riga chiusa (gli archivi paginati), altrimenti contando gli id
+def cold_count(table_name, filters):
+    arch = _cold_archive(table_name)
+    if arch is None: return 0
+    try: n = arch.count(table_name, filters)
+    except: n = None
+    return len(cold_df(table_name, "id", filters)) if n is None else n
+
+# Cambia a ogni scrittura dell'archivio: chiave per i calcoli derivati, come la versione del mirror
+def archive_version(table_name):
+    arch = get_archive()
+    return max((m.get("scritto", 0) for m in arch.index(table_name).values()), default=0) if arch else 0
+
+def get_history(table_name, cols="*", filters=None, order=None, desc=False, limit=None):
+    want = None if cols == "*" else [c.strip() for c in cols.split(",")]
+    q = cols if want is None or "id" in want else "id," + cols
+    df, old = get_df(table_name, q, filters, order, desc, limit), cold_df(table_name, q, filters)
+    if not old.empty:
+        if 'id' in df.columns: old = old[~old['id'].isin(df['id'])]
+        df = pd.concat([x for x in (df, old) if not x.empty], ignore_index=True)
+        if _order(order): df = df.sort_values(_order(order), ascending=not desc, kind="stable")
+        if limit: df = df.head(limit)
+        df = df.reset_index(drop=True)
+    return df if want is None or "id" in want or 'id' not in df.columns else df.drop(columns="id")
+
+# Eliminazione per id sia dalle righe vive sia dall'archivio
+def delete_history(table_name, ids):
+    ids = [int(i) for i in ids]
+    db_delete(table_name, [("in_", "id", ids)])
+    arch = _cold_archive(table_name)
+    if arch and arch.months(table_name, ids=ids) and arch.delete(table_name, ids): get_cold_cache().invalidate(table_name)
+
+# ------------------------------------------------------------------------------
+# Riepilogo ore per (username, location, giorno): Report Ore e Matrice leggono
+# qui invece di ricalcolare tutti i turni. Si aggiorna ricalcolando solo le celle
+# toccate (uscita timbrata, log eliminati); rollup_backfill lo ricostruisce da logs.
+# ------------------------------------------------------------------------------
+ROLLUP_TABLE = "ore_giornaliere"
+
+def _rollup_rows(df):
+    df = df.assign(giorno=to_dt(df['start_time']).dt.strftime('%Y-%m-%d'), ore=shift_hours(df))
+    g = df.groupby(['username', 'location', 'giorno']).agg(ore=('ore', 'sum'), turni=('ore', 'size')).reset_index()
+    g['ore'] = g['ore'].round(2)
+    return g.to_dict('records')
+
+# Celle (username, location, giorno) a cui appartengono le righe di logs date
+def rollup_keys(df):
+    if df.empty: return []
+    giorni = to_dt(df['start_time']).dt.strftime('%Y-%m-%d')
+    return list(zip(df['username'], df['location'], giorni))
+
+def rollup_refresh(keys):
+    rows = []
+    for u, loc, giorno in set(keys):
+        t0, t1 = day_bounds(datetime.fromisoformat(giorno))
+        df = get_history("logs", "username,location,start_time,end_time", [("eq", "username", u), ("eq", "location", loc), ("not_is", "end_time", "null"), ("gte", "start_time", t0), ("lt", "start_time", t1)])
+        if df.empty: db_delete(ROLLUP_TABLE, [("eq", "username", u), ("eq", "location", loc), ("eq", "giorno", giorno)])
+        else: rows += _rollup_rows(df)
+    # Le celle ancora con turni: un solo upsert
+    if rows: db_upsert(ROLLUP_TABLE, rows, "username,location,giorno")
+
+def rollup_backfill():
+    df = get_history("logs", "username,location,start_time,end_time", [("not_is", "end_time", "null")])
+    rows = _rollup_rows(df) if not df.empty else []
+    for i in range(0, len(rows), 500): db_upsert(ROLLUP_TABLE, rows[i:i + 500], "username,location,giorno")
+    # Celle rimaste senza turni (log cancellati prima del riepilogo)
+    old = get_df(ROLLUP_TABLE, "id,username,location,giorno")
+    if not old.empty:
+        keep = {(r['username'], r['location'], r['giorno']) for r in rows}
+        stale = [int(r.id) for r in old.itertuples() if (r.username, r.location, str(r.giorno)[:10]) not in keep]
+        for i in range(0, len(stale), 500): db_delete(ROLLUP_TABLE, [("in_", "id", stale[i:i + 500])])
+    return len(rows)
+
+# Totale ore dal riepilogo; giorni = (primo, dopo l'ultimo) in YYYY-MM-DD
+def rollup_df(g0, g1, username=None, location=None):
+    flt = [("gte", "giorno", g0), ("lt", "giorno", g1)]
+    if username: flt.append(("eq", "username", username))
+    if location: flt.append(("eq", "location", location))
+    return get_df(ROLLUP_TABLE, "username,location,giorno,ore,turni", flt)
+
+# Matrice di tutta l'azienda: ore del mese per (dipendente, postazione) × giorno.
+# Una query sul riepilogo e un pivot; sta nella cache di processo sotto la tabella
+# del riepilogo, quindi le sue scritture la invalidano come le altre letture.
+CUBE_TTL = 300
+
+def month_cube(mese):
+    def load():
+        t0, t1 = month_bounds(mese)
+        df = rollup_df(t0[:10], t1[:10])
+        if df.empty: return pd.DataFrame()
+        df = df.assign(giorno=to_dt(df['giorno']).dt.day)
+        cube = df.pivot_table(index=['username', 'location'], columns='giorno', values='ore', aggfunc='sum', fill_value=0)
+        cube['TOTALE'] = cube.sum(axis=1)
+        return cube.round(2)
+    return get_cache().get((ROLLUP_TABLE, "cubo", mese), load, ttl=CUBE_TTL)
+
+# Totali per dipendente (somma delle postazioni)
+def cube_staff(cube):
+    return cube.groupby(level='username').sum().round(2) if not cube.empty else cube
+
+def cube_excel(mese):
+    def load():
+        cube = month_cube(mese)
+        names = ref_data().names
+        out = io.BytesIO()
+        with pd.ExcelWriter(out, engine="xlsxwriter") as xw:
+            tot = cube_staff(cube)
+            tot.insert(0, "Nome", [names.get(u, u) for u in tot.index])
+            tot.rename_axis("Dipendente").to_excel(xw, sheet_name="Riepilogo")
+            cube.rename_axis(["Dipendente", "Postazione"]).to_excel(xw, sheet_name="Dettaglio")
+        return out.getvalue()
+    return get_cache().get((ROLLUP_TABLE, "cubo_xlsx", mese), load, ttl=CUBE_TTL)
+
+# ------------------------------------------------------------------------------
+# Export Excel: si costruisce solo su richiesta, con gli stessi filtri del report.
+# xlsxwriter in constant_memory scrive riga per riga su file temporaneo, quindi la
+# memoria non cresce con il periodo; il file è in cache per filtri + versione dati.
+# ------------------------------------------------------------------------------
+XLSX_HEADER = ["Dipendente", "Postazione", "Inizio", "Fine", "Ore"]
+
+def _sheet_name(name, used):
+    base = re.sub(r'[\[\]:*?/\\]', '_', str(name))[:31] or "_"
+    name, i = base, 1
+    while name.lower() in used: i += 1; name = f"{base[:28]}_{i}"
+    used.add(name.lower())
+    return name
+
+@st.cache_data(max_entries=16, ttl=3600, show_spinner=False)
+def build_excel(filters, per_dipendente, data_version):
+    import xlsxwriter
+    with tempfile.TemporaryFile() as tmp:
+        wb = xlsxwriter.Workbook(tmp, {'constant_memory': True, 'tmpdir': tempfile.gettempdir()})
+        bold, fmt_dt = wb.add_format({'bold': True}), wb.add_format({'num_format': 'dd/mm/yyyy hh:mm'})
+        used, sheets, totals = set(), {}, {}
+
+        def new_sheet(name):
+            ws = wb.add_worksheet(_sheet_name(name, used))
+            ws.write_row(0, 0, XLSX_HEADER, bold); ws.set_column(0, 1, 20); ws.set_column(2, 3, 17)
+            return [ws, 1]
+
+        sheets[None] = new_sheet("Report")
+        df = get_history("logs", "username,location,start_time,end_time", list(filters), order="start_time")
+        if not df.empty:
+            df['start_time'] = to_dt(df['start_time']); df['end_time'] = to_dt(df['end_time'])
+            df['Ore'] = shift_hours(df)
+            for r in df.itertuples(index=False):
+                targets = [None] + ([r.username] if per_dipendente else [])
+                for t in targets:
+                    if t not in sheets: sheets[t] = new_sheet(t)
+                    ws, row = sheets[t]
+                    ws.write_string(row, 0, str(r.username)); ws.write_string(row, 1, str(r.location))
+                    ws.write_datetime(row, 2, r.start_time.to_pydatetime().replace(tzinfo=None), fmt_dt)
+                    ws.write_datetime(row, 3, r.end_time.to_pydatetime().replace(tzinfo=None), fmt_dt)
+                    ws.write_number(row, 4, float(r.Ore))
+                    sheets[t][1] += 1
+                k = (r.username, r.location)
+                ore, turni = totals.get(k, (0.0, 0))
+                totals[k] = (ore + float(r.Ore), turni + 1)
+
+        ws = wb.add_worksheet(_sheet_name("Totali", used))
+        ws.write_row(0, 0, ["Dipendente", "Postazione", "Turni", "Ore"], bold); ws.set_column(0, 1, 20)
+        for i, ((u, loc), (ore, turni)) in enumerate(sorted(totals.items()), start=1):
+            ws.write_row(i, 0, [str(u), str(loc), turni, round(ore, 2)])
+        ws.write_row(len(totals) + 1, 0, ["TOTALE", "", sum(t for _, t in totals.values()), round(sum(o for o, _ in totals.values()), 2)], bold)
+        wb.close()
+        tmp.seek(0)
+        return tmp.read()
+
+# ------------------------------------------------------------------------------
+# MAPPA GPS: un solo deck per tutti i turni filtrati
+# Ingressi e uscite come punti colorati per dipendente, linea ingresso→uscita.
+# Oltre GPS_CLUSTER_MIN turni i punti sono raggruppati su griglia lato server,
+# così il payload verso il browser resta limitato anche su intervalli lunghi.
+# ------------------------------------------------------------------------------
+GPS_CLUSTER_MIN = 400
+GPS_CELL = 0.01  # gradi (~1 km)
+GPS_PALETTE = [(46, 125, 50), (25, 118, 210), (211, 47, 47), (245, 127, 23), (123, 31, 162), (0, 131, 143),
+               (194, 24, 91), (93, 64, 55), (85, 139, 47), (69, 90, 100), (255, 160, 0), (48, 63, 159)]
+
+def user_color(username):
+    return list(GPS_PALETTE[zlib.crc32(str(username).encode()) % len(GPS_PALETTE)])
+
+def gps_cell(lat, lon):
+    return (lat // GPS_CELL).astype(int).astype(str) + ":" + (lon // GPS_CELL).astype(int).astype(str)
+
+def gps_deck(df, flags, sites):
+    import pydeck as pdk
+    pts = pd.DataFrame({
+        "id": df['id'].astype(int), "username": df['username'].astype(str), "location": df['location'].astype(str),
+        "ora": df['start_time'].dt.strftime('%d/%m %H:%M'), "lat": df['gps_lat'].astype(float), "lon": df['gps_lon'].astype(float),
+        "lat_out": pd.to_numeric(df['gps_lat_out'], errors="coerce"), "lon_out": pd.to_numeric(df['gps_lon_out'], errors="coerce"),
+    })
+    pts['color'] = pts['username'].map(user_color)
+    pts['geo'] = [("⚠️ fuori area: " + geofence_label(flags, i)) if i in flags.index else "" for i in pts['id']]
+    span = max(pts['lat'].max() - pts['lat'].min(), pts['lon'].max() - pts['lon'].min(), 0.002)
+    view = pdk.ViewState(latitude=pts['lat'].mean(), longitude=pts['lon'].mean(), zoom=max(4, min(16, math.log2(360 / span) - 1)))
+    if len(pts) > GPS_CLUSTER_MIN:
+        pts['cella'] = gps_cell(pts['lat'], pts['lon'])
+        cl = pts.groupby('cella').agg(lat=('lat', 'mean'), lon=('lon', 'mean'), turni=('id', 'size'), utenti=('username', 'nunique')).reset_index()
+        cl['r'] = 60 * cl['turni'] ** 0.5
+        layers = [pdk.Layer("ScatterplotLayer", data=cl, id="cluster", get_position=["lon", "lat"], get_radius="r", radius_min_pixels=4,
+                            get_fill_color=[46, 125, 50, 160], get_line_color=[255, 255, 255], stroked=True, pickable=True)]
+        tip = {"text": "{turni} turni, {utenti} dipendenti"}
+    else:
+        fuori = flags.reindex(pts['id']).fillna(False)
+        ring = pd.concat([pts.loc[fuori['fuori_in'].to_numpy().astype(bool), ['lat', 'lon']],
+                          pts.loc[fuori['fuori_out'].to_numpy().astype(bool), ['lat_out', 'lon_out']].set_axis(['lat', 'lon'], axis=1)])
+        out = pts.dropna(subset=['lat_out', 'lon_out'])
+        out = out[(out['lat_out'] != 0) & (out['lon_out'] != 0)]
+        layers = [
+            pdk.Layer("ScatterplotLayer", data=ring, id="fuori", get_position=["lon", "lat"], get_radius=30, radius_min_pixels=10,
+                      filled=False, stroked=True, get_line_color=[211, 47, 47], line_width_min_pixels=3),
+            pdk.Layer("LineLayer", data=out, id="tratta", get_source_position=["lon", "lat"], get_target_position=["lon_out", "lat_out"],
+                      get_color="color", get_width=2),
+            pdk.Layer("ScatterplotLayer", data=pts.drop(columns=['lat_out', 'lon_out']), id="in", get_position=["lon", "lat"],
+                      get_fill_color="color", get_radius=12, radius_min_pixels=5, pickable=True),
+            pdk.Layer("ScatterplotLayer", data=out.drop(columns=['lat', 'lon']), id="out", get_position=["lon_out", "lat_out"],
+                      get_fill_color=[255, 255, 255], get_line_color="color", stroked=True, line_width_min_pixels=2,
+                      get_radius=12, radius_min_pixels=5, pickable=True),
+        ]
+        tip = {"text": "{username} @ {location}\n{ora}\n{geo}"}
+    # Area di ogni cantiere (cerchio del raggio di tolleranza) sotto i punti
+    geo = sites.dropna(subset=['lat', 'lon']).assign(raggio_m=lambda x: x['raggio_m'].fillna(GEO_RAGGIO_M))
+    if not geo.empty:
+        layers.insert(0, pdk.Layer("ScatterplotLayer", data=geo, id="cantieri", get_position=["lon", "lat"], get_radius="raggio_m",
+                                   get_fill_color=[46, 125, 50, 40], get_line_color=[46, 125, 50, 120], stroked=True, line_width_min_pixels=1))
+    return pdk.Deck(layers=layers, initial_view_state=view, tooltip=tip, map_style=None), pts
+
+# ------------------------------------------------------------------------------
+# GEOFENCE: timbrature lontane dal cantiere
+# Ogni cantiere ha lat/lon e raggio_m. Le distanze si calcolano in blocco con
+# NumPy su tutta la tabella logs (archivio freddo compreso), una volta per
+# versione del mirror e dell'archivio (non a ogni rerun); l'indice a griglia trova il cantiere più vicino ai punti fuori area.
+# ------------------------------------------------------------------------------
+GEO_RAGGIO_M = 200   # raggio se il cantiere non lo specifica
+GEO_CELL = 0.05      # gradi, lato cella dell'indice (~5 km)
+EARTH_R = 6371000.0
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_R * np.arcsin(np.sqrt(a))
+
+class SiteIndex:
+    def __init__(self, sites):
+        self.names = sites['nome_cantiere'].to_numpy()
+        self.lat, self.lon = sites['lat'].to_numpy(float), sites['lon'].to_numpy(float)
+        self.cells = {}
+        for i, c in enumerate(zip(*self._cell(self.lat, self.lon))): self.cells.setdefault(c, []).append(i)
+
+    @staticmethod
+    def _cell(lat, lon):
+        return np.floor(lat / GEO_CELL).astype(int), np.floor(lon / GEO_CELL).astype(int)
+
+    # Cantiere più vicino e distanza, cercando nelle 9 celle attorno al punto (oltre ~GEO_CELL: nessuno)
+    def nearest(self, lat, lon):
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        names, dist = np.full(len(lat), None, dtype=object), np.full(len(lat), np.nan)
+        if not len(lat): return names, dist
+        ci, cj = self._cell(lat, lon)
+        for c in set(zip(ci.tolist(), cj.tolist())):
+            cand = [k for di in (-1, 0, 1) for dj in (-1, 0, 1) for k in self.cells.get((c[0] + di, c[1] + dj), [])]
+            if not cand: continue
+            m = (ci == c[0]) & (cj == c[1])
+            d = haversine_m(lat[m][:, None], lon[m][:, None], self.lat[cand][None, :], self.lon[cand][None, :])
+            best = d.argmin(axis=1)
+            names[m], dist[m] = self.names[cand][best], d[np.arange(len(best)), best]
+        return names, dist
+
+# Solo i turni con almeno una timbratura fuori area, indicizzati per id
+GEO_COLS = ["dist_in", "dist_out", "fuori_in", "fuori_out", "vicino_in", "vicino_out"]
+
+def _geofence_rows(logs, sites):
+    cols = GEO_COLS
+    sites = sites.dropna(subset=['lat', 'lon'])
+    if logs.empty or sites.empty: return pd.DataFrame(columns=cols, index=pd.Index([], name="id"))
+    ref = sites.drop_duplicates('nome_cantiere').set_index('nome_cantiere')
+    lat0, lon0 = logs['location'].map(ref['lat']).to_numpy(float), logs['location'].map(ref['lon']).to_numpy(float)
+    raggio = logs['location'].map(ref['raggio_m']).fillna(GEO_RAGGIO_M).to_numpy(float)
+    out = pd.DataFrame({"id": logs['id'].astype(int)})
+    pts = {}
+    for side, c_lat, c_lon in (("in", "gps_lat", "gps_lon"), ("out", "gps_lat_out", "gps_lon_out")):
+        plat = pd.to_numeric(logs[c_lat], errors="coerce").to_numpy(float)
+        plon = pd.to_numeric(logs[c_lon], errors="coerce").to_numpy(float)
+        ok = ~np.isnan(plat) & ~np.isnan(plon) & (plat != 0) & ~np.isnan(lat0)
+        d = np.full(len(logs), np.nan)
+        d[ok] = haversine_m(plat[ok], plon[ok], lat0[ok], lon0[ok])
+        out[f"dist_{side}"], out[f"fuori_{side}"] = d, d > raggio
+        pts[side] = (plat, plon)
+    flag = (out['fuori_in'] | out['fuori_out']).to_numpy()
+    out = out[flag].copy()
+    idx = SiteIndex(sites)
+    for side, (plat, plon) in pts.items():
+        out[f"vicino_{side}"] = None
+        m = out[f"fuori_{side}"].to_numpy()
+        if m.any(): out.loc[m, f"vicino_{side}"] = idx.nearest(plat[flag][m], plon[flag][m])[0]
+    return out.set_index('id')[cols]
+
+# I turni vivi si ricalcolano a ogni versione del mirror, i mesi archiviati solo
+# quando cambia l'archivio: una timbratura nuova non rilegge il Parquet
+@st.cache_data(max_entries=4, show_spinner=False)
+def geofence_flags(logs_version, sites):
+    return _geofence_rows(get_mirror("logs").df, sites)
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def geofence_cold_flags(arch_version, sites):
+    return _geofence_rows(cold_df("logs", "id,location,gps_lat,gps_lon,gps_lat_out,gps_lon_out", []), sites)
+
+def get_sites():
+    return ref_data().sites
+
+def geofence(sites=None):
+    try:
+        mirror = get_mirror("logs"); mirror.refresh()
+        sites = get_sites() if sites is None else sites
+        live, old = geofence_flags(mirror.version, sites), geofence_cold_flags(archive_version("logs"), sites)
+        # Per id vince la riga viva (anche se lì non è più fuori area)
+        if 'id' in mirror.df.columns: old = old[~old.index.isin(mirror.df['id'])]
+        return pd.concat([x for x in (live, old) if not x.empty]) if not old.empty else live
+    except:
+        return pd.DataFrame(columns=GEO_COLS)
+
+def fmt_dist(m):
+    return f"{m / 1000:.1f} km" if m >= 1000 else f"{m:.0f} m"
+
+# Testo breve per liste e tabelle: "IN 1.2 km · OUT 850 m"
+def geofence_label(flags, log_id):
+    if log_id not in flags.index: return ""
+    f = flags.loc[log_id]
+    return " · ".join(f"{side.upper()} {fmt_dist(f['dist_' + side])}" for side in ("in", "out") if f['fuori_' + side])
+
+# Foto: orientamento corretto, EXIF eliminati (anche il GPS del telefono),
+# JPEG ricompresso con lato massimo limitato + miniatura per le liste admin
+PHOTO_MAX_SIDE = 1600
+PHOTO_QUALITY = 80
+THUMB_MAX_SIDE = 320
+THUMB_QUALITY = 70
+
+def _jpeg(img, max_side, quality):
+    from PIL import Image
+    img = img.copy()
+    img.thumbnail((max_side, max_side), Image.LANCZOS)
+    out = io.BytesIO()
+    img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+def prepare_photo(file_bytes):
+    from PIL import Image, ImageOps
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(file_bytes)))
+    if img.mode != "RGB": img = img.convert("RGB")
+    return _jpeg(img, PHOTO_MAX_SIDE, PHOTO_QUALITY), _jpeg(img, THUMB_MAX_SIDE, THUMB_QUALITY)
+
+# Ritorna (url foto, url miniatura); se l'immagine non è leggibile carico l'originale.
+# Gli errori di rete salgono al chiamante (la coda li ritenta).
+def upload_photo(name, file_bytes, content_type):
+    bucket = "foto_cantieri"
+    # uuid: due foto con lo stesso nome nello stesso secondo non si sovrascrivono
+    prefix = f"{int(time.time())}_{uuid.uuid4().hex[:12]}"
+    file_name = f"{prefix}_{os.path.splitext(name)[0]}.jpg"
+    try:
+        full, thumb = prepare_photo(file_bytes)
+    except Exception:
+        file_name = f"{prefix}_{name}"
+        db.upload(bucket, file_name, file_bytes, {"content-type": content_type})
+        return db.public_url(bucket, file_name), None
+    opts = {"content-type": "image/jpeg", "cache-control": "31536000"}
+    db.upload(bucket, file_name, full, opts)
+    db.upload(bucket, f"thumb/{file_name}", thumb, opts)
+    return db.public_url(bucket, file_name), db.public_url(bucket, f"thumb/{file_name}")
+
+# ------------------------------------------------------------------------------
+# Coda di caricamento foto: la segnalazione viene salvata subito con
+# image_status = PENDING, il caricamento gira in un thread e aggiorna la riga
+# a fine lavoro (OK) o dopo l'ultimo tentativo fallito (ERRORE, visibile all'admin).
+# ------------------------------------------------------------------------------
+UPLOAD_WORKERS = 2
+UPLOAD_RETRIES = 4
+UPLOAD_BACKOFF = 2  # secondi, raddoppia a ogni tentativo
+UPLOAD_STALE = timedelta(minutes=15)  # PENDING più vecchio di così = non arriverà più
+
+@st.cache_resource
+def get_upload_pool():
+    return ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+
+def _upload_job(issue_id, name, file_bytes, content_type):
+    err = None
+    for attempt in range(UPLOAD_RETRIES):
+        try:
+            url, thumb = upload_photo(name, file_bytes, content_type)
+            db_update("issues", {"image_url": url, "thumb_url": thumb, "image_status": "OK", "image_error": None}, [("eq", "id", issue_id)])
+            return
+        except Exception as e:
+            err = e
+            if attempt < UPLOAD_RETRIES - 1: time.sleep(UPLOAD_BACKOFF * 2 ** attempt)
+    try: db_update("issues", {"image_status": "ERRORE", "image_error": str(err)[:300]}, [("eq", "id", issue_id)])
+    except Exception: pass
+
+def queue_photo(issue_id, file):
+    get_upload_pool().submit(_upload_job, issue_id, file.name, file.getvalue(), file.type)
+
+# ------------------------------------------------------------------------------
+# BACHECA: destinatari come array, annunci scaduti in archivio
+# Un dipendente vede gli annunci con "TUTTI" o il suo username tra i
+# destinatari e non ancora scaduti: una sola query filtrata e ordinata
+# (indice GIN su destinatari). La pulizia sposta gli scaduti in
+# bacheca_archivio al più una volta ogni BACHECA_PURGE_EVERY per processo.
+# ------------------------------------------------------------------------------
+BACHECA_PURGE_EVERY = 3600
+BACHECA_PURGE_BATCH = 500
+
+def bacheca_attivi(username=None, cols="id,titolo,messaggio,destinatario,destinatari,data_pubblicazione,data_scadenza"):
+    flt = [("gt", "data_scadenza", now_minute())]
+    if username: flt.append(("ov", "destinatari", ["TUTTI", username]))
+    return get_df("bacheca", cols, flt, order="data_pubblicazione", desc=True)
+
+@st.cache_resource
+def _bacheca_purge_state():
+    return {"lock": threading.Lock(), "last": None}
+
+# Upsert prima, delete dopo: se si interrompe a metà il giro successivo riprende senza doppioni
+def bacheca_purge(force=False):
+    state = _bacheca_purge_state()
+    if not force and state["last"] is not None and time.monotonic() - state["last"] < BACHECA_PURGE_EVERY: return 0
+    if not state["lock"].acquire(blocking=False): return 0
+    try:
+        state["last"] = time.monotonic()
+        rows, _ = db.select("bacheca", "*", [("lt", "data_scadenza", datetime.now().isoformat())], order=["id"], limit=BACHECA_PURGE_BATCH)
+        if not rows: return 0
+        db.upsert("bacheca_archivio", rows, "id")
+        db_delete("bacheca", [("in_", "id", [r['id'] for r in rows])])
+        return len(rows)
+    except:
+        return 0
+    finally:
+        state["lock"].release()
+
+# ------------------------------------------------------------------------------
+# TIMBRATURE: coda durevole sul server dell'app
+# La timbratura viene confermata subito con l'ora del click e il GPS del
+# telefono, salvata in un file SQLite sul server Streamlit e inviata al
+# database da un thread con retry e backoff. client_id (uuid del turno) rende
+# gli invii ripetuti innocui: l'ingresso è un upsert su client_id, l'uscita un
+# update sullo stesso turno. Le timbrature di un dipendente partono in ordine:
+# se l'ingresso non è ancora arrivato l'uscita aspetta.
+# La coda copre i problemi tra app e database (Supabase lento o giù), non il
+# telefono offline: Streamlit gira sul server, e un click che non arriva al
+# server non viene registrato. Dopo PUNCH_MAX_ATTEMPTS tentativi (o
+# PUNCH_MAX_MISSING se il turno non esiste) la timbratura passa in ERRORE,
+# sblocca le successive e compare al dipendente e all'admin (Sicurezza).
+# ------------------------------------------------------------------------------
+# Fuori dalla cartella dell'app, che un redeploy può sostituire; su host senza
+# disco persistente CHEMIFOL_PUNCH_DB va puntato su un volume montato
+PUNCH_DB = os.environ.get("CHEMIFOL_PUNCH_DB") or os.path.join(
+    os.environ.get("XDG_STATE_HOME") or os.path.expanduser(os.path.join("~", ".local", "state")), "chemifol", "punch_queue.db")
+PUNCH_POLL = 5          # secondi tra due giri del thread di invio
+PUNCH_BACKOFF = 2       # secondi, raddoppia a ogni tentativo fallito
+PUNCH_BACKOFF_MAX = 120
+PUNCH_MAX_MISSING = 20  # uscite senza turno sul server (es. log eliminato): poi ERRORE
+PUNCH_MAX_ATTEMPTS = 40  # qualsiasi altro errore ripetuto (~70 minuti di tentativi): poi ERRORE
+PUNCH_KEEP = timedelta(days=7)  # timbrature già inviate tenute nel file per controllo
+SHIFT_TTL = 300         # secondi di validità del turno aperto in sessione
+
+class PunchQueue:
+    def __init__(self, path, apply):
+        self.apply = apply
+        self._lock, self._flush_lock, self._wake = threading.Lock(), threading.Lock(), threading.Event()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("pragma journal_mode=wal")
+        self._conn.execute("""create table if not exists punches (
+            seq integer primary key autoincrement, client_id text unique, shift text, kind text, username text,
+            payload text, created_at text, status text default 'PENDING', attempts integer default 0,
+            next_try real default 0, last_error text)""")
+        threading.Thread(target=self._run, name="punch-flush", daemon=True).start()
+
+    def _q(self, sql, args=()):
+        with self._lock: return self._conn.execute(sql, args).fetchall()
+
+    def put(self, kind, username, shift, payload):
+        self._q("insert into punches (client_id, shift, kind, username, payload, created_at) values (?, ?, ?, ?, ?, ?)",
+                (uuid.uuid4().hex, shift, kind, username, json.dumps(payload), datetime.now().isoformat()))
+        self._wake.set()
+
+    def pending(self, username):
+        return [dict(r) for r in self._q("select * from punches where username = ? and status = 'PENDING' order by seq", (username,))]
+
+    # Timbrature che non sono arrivate al database (tutte, o di un dipendente)
+    def errors(self, username=None):
+        sql, args = "select * from punches where status = 'ERRORE'", ()
+        if username: sql, args = sql + " and username = ?", (username,)
+        return [dict(r) for r in self._q(sql + " order by seq", args)]
+
+    # Admin: rimette in coda da zero, o scarta
+    def retry(self, seq):
+        self._q("update punches set status = 'PENDING', attempts = 0, next_try = 0 where seq = ? and status = 'ERRORE'", (seq,))
+        self._wake.set()
+
+    def discard(self, seq):
+        self._q("update punches set status = 'SCARTATA' where seq = ? and status = 'ERRORE'", (seq,))
+
+    def flush(self):
+        with self._flush_lock:
+            blocked = set()
+            for r in self._q("select * from punches where status = 'PENDING' order by seq"):
+                if r['username'] in blocked: continue
+                if r['next_try'] > time.time():
+                    blocked.add(r['username']); continue
+                try:
+                    ok, err = self.apply(r['kind'], json.loads(r['payload'])), "turno non trovato"
+                except Exception as e:
+                    ok, err = False, repr(e)[:300]
+                if ok:
+                    self._q("update punches set status = 'OK', last_error = null where seq = ?", (r['seq'],))
+                    continue
+                n = r['attempts'] + 1
+                limit = PUNCH_MAX_MISSING if err == "turno non trovato" else PUNCH_MAX_ATTEMPTS
+                status = "ERRORE" if n >= limit else "PENDING"
+                self._q("update punches set attempts = ?, next_try = ?, last_error = ?, status = ? where seq = ?",
+                        (n, time.time() + min(PUNCH_BACKOFF * 2 ** n, PUNCH_BACKOFF_MAX), err, status, r['seq']))
+                # In ERRORE non blocca più: le successive del dipendente possono partire
+                if status == "PENDING": blocked.add(r['username'])
+            self._q("delete from punches where status in ('OK', 'SCARTATA') and created_at < ?", ((datetime.now() - PUNCH_KEEP).isoformat(),))
+
+    def _run(self):
+        while True:
+            self._wake.wait(PUNCH_POLL); self._wake.clear()
+            try: self.flush()
+            except Exception: pass
+
+def _apply_punch(kind, p):
+    if kind == "in":
+        return bool(db_upsert("logs", p['row'], "client_id"))
+    rows = db_update("logs", p['values'], [("eq", p['match'][0], p['match'][1])])
+    # L'esito è solo l'update: end_time è già salvato, un riepilogo non aggiornato
+    # lo rimette a posto "RICOSTRUISCI RIEPILOGO" (rollup_backfill)
+    if rows:
+        try: rollup_refresh([(rows[0]['username'], rows[0]['location'], str(rows[0]['start_time'])[:10])])
+        except: pass
+    return bool(rows)
+
+@st.cache_resource
+def get_punch_queue():
+    if os.path.dirname(PUNCH_DB): os.makedirs(os.path.dirname(PUNCH_DB), exist_ok=True)
+    return PunchQueue(PUNCH_DB, _apply_punch)
+
+def punch_label(r):
+    return f"{'Ingresso' if r['kind'] == 'in' else 'Uscita'} del {r['created_at'][:16].replace('T', ' ')}"
+
+# Turno aperto dell'utente: prima la coda locale (ancora da inviare), poi la
+# sessione, poi una sola query sull'indice logs_open_shift_idx
+def open_shift(username):
+    q = get_punch_queue().pending(username)
+    if q:
+        last = json.loads(q[-1]['payload'])
+        return last['row'] if q[-1]['kind'] == "in" else None
+    cached = st.session_state.get("shift")
+    if cached and cached['user'] == username and time.monotonic() - cached['ts'] < SHIFT_TTL:
+        return cached['row']
+    rows, _ = db.select("logs", "id,client_id,location,start_time", [("eq", "username", username), ("is_", "end_time", "null")],
+                        order=["start_time"], desc=True, limit=1)
+    row = rows[0] if rows else None
+    st.session_state.shift = {"user": username, "row": row, "ts": time.monotonic()}
+    return row
+
+def punch_in(username, location, gps):
+    row = {"client_id": uuid.uuid4().hex, "username": username, "location": location, "start_time": datetime.now().isoformat(),
+           "gps_lat": gps['coords']['latitude'], "gps_lon": gps['coords']['longitude'], "visto": 0}
+    get_punch_queue().put("in", username, row['client_id'], {"row": row})
+    st.session_state.shift = {"user": username, "row": row, "ts": time.monotonic()}
+    return row
+
+def punch_out(username, shift, gps):
+    match = ("client_id", shift['client_id']) if shift.get('client_id') else ("id", int(shift['id']))
+    values = {"end_time": datetime.now().isoformat(), "gps_lat_out": gps['coords']['latitude'],
+              "gps_lon_out": gps['coords']['longitude'], "visto": 0}
+    get_punch_queue().put("out", username, str(match[1]), {"match": match, "values": values})
+    st.session_state.shift = {"user": username, "row": None, "ts": time.monotonic()}
+    return values
+
+# ------------------------------------------------------------------------------
+# ANAGRAFICHE: istantanea condivisa di dipendenti, cantieri e assegnazioni
+# Caricata una volta per processo (tre query) con indici in dizionari e set;
+# le scritture dell'app su queste tabelle la invalidano, REF_TTL copre le
+# modifiche fatte da altri processi.
+# ------------------------------------------------------------------------------
+REF_TABLES = ("users", "cantieri", "assignments")
+REF_TTL = 60
+
+class RefSnapshot:
+    def __init__(self, users, cantieri, assignments):
+        staff = users[users['role'] == 'user'] if not users.empty else users
+        self.staff = list(dict.fromkeys(staff['username'])) if not staff.empty else []
+        self.names = dict(zip(users['username'], users['nome_completo'])) if not users.empty else {}
+        attivi = cantieri[cantieri['attivo'] == 1] if not cantieri.empty else cantieri
+        self.cantieri = sorted(set(attivi['nome_cantiere'])) if not attivi.empty else []
+        self.active = set(self.cantieri)
+        self.sites = cantieri.reindex(columns=['nome_cantiere', 'lat', 'lon', 'raggio_m'])
+        self.locs_by_user, self.users_by_loc = {}, {}
+        for u, loc in (zip(assignments['username'], assignments['location']) if not assignments.empty else []):
+            self.locs_by_user.setdefault(u, []).append(loc)
+            self.users_by_loc.setdefault(loc, set()).add(u)
+
+    def locations(self, username):
+        return self.locs_by_user.get(username, [])
+
+    def users_at(self, location):
+        return self.users_by_loc.get(location, set())
+
+class RefHolder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.snap, self.loaded, self.gen = None, 0.0, 0
+
+    def get(self):
+        with self._lock:
+            if self.snap is None or time.monotonic() - self.loaded > REF_TTL:
+                gen = self.gen
+                snap = RefSnapshot(*(pd.DataFrame(rows) for rows, _ in run_parallel([
+                    lambda: db.select("users", "username,role,nome_completo"),
+                    lambda: db.select("cantieri", "id,nome_cantiere,attivo,lat,lon,raggio_m", order=["id"]),
+                    lambda: db.select("assignments", "username,location", order=["id"])])))
+                # Invalidata mentre caricavo: la uso per questo giro ma non la tengo
+                if gen != self.gen: return snap
+                self.snap, self.loaded = snap, time.monotonic()
+            return self.snap
+
+    def invalidate(self):
+        self.gen += 1
+        self.snap = None
+
+@st.cache_resource
+def get_ref_holder():
+    return RefHolder()
+
+def _empty_ref():
+    return RefSnapshot(pd.DataFrame(), pd.DataFrame(), pd.DataFrame())
+
+def ref_data():
+    if not db: return _empty_ref()
+    try: return get_ref_holder().get()
+    except: return _empty_ref()
 
 def get_all_cantieri():
-    df = get_df("cantieri")
-    if not df.empty and 'attivo' in df.columns:
-        return sorted(df[df['attivo'] == 1]['nome_cantiere'].unique().tolist())
-    elif not df.empty and 'nome_cantiere' in df.columns:
-        return sorted(df['nome_cantiere'].unique().tolist())
-    return []
+    return ref_data().cantieri
 
 def get_all_staff():
-    df = get_df("users")
-    if not df.empty:
-        return df[df['role'] == 'user']['username'].unique().tolist()
-    return []
+    return ref_data().staff
+
+# Profilo per la sessione (mai la password). L'auto-login con u_persist lo legge
+# dalla cache di processo: le scritture su users la invalidano.
+PROFILE_COLS = "id,username,role,nome_completo,pwd_changed"
+PROFILE_TTL = 300
+
+def user_profile(username):
+    rows = get_cache().get(("users", "profilo", username), lambda: db.select("users", PROFILE_COLS, [("eq", "username", username)])[0], ttl=PROFILE_TTL)
+    return dict(rows[0]) if rows else None
+
+# ------------------------------------------------------------------------------
+# LISTE IN ATTESA (admin): frammenti che si aggiornano da soli
+# Ogni LIVE_EVERY secondi si riesegue solo il frammento, non CSS, logo e
+# sidebar. I dati arrivano dal mirror: il delta verso il server parte al
+# massimo ogni SYNC_INTERVAL per tutto il processo, quindi un giro a vuoto
+# costa un filtro in memoria. Le righe con id oltre l'ultimo visto = notifica.
+# ------------------------------------------------------------------------------
+LIVE_EVERY = 10
+
+def live_notify(key, df, label):
+    last = st.session_state.get(key)
+    top = int(df['id'].max()) if not df.empty else 0
+    if last is not None and top > last:
+        n = int((df['id'] > last).sum())
+        st.toast(f"{label}: {n} nuov{'a' if n == 1 else 'e'}", icon="🔔")
+    st.session_state[key] = max(top, last or 0)
+
+# Esito delle azioni nel frammento: mostrato al giro dopo st.rerun(scope="fragment")
+def live_feedback():
+    msg = st.session_state.pop("live_msg", None)
+    if msg: st.toast(msg, icon="✅")
+
+# Un click arrivato durante un rerun completo non può chiedere scope="fragment"
+def live_rerun(msg):
+    st.session_state.live_msg = msg
+    try: st.rerun(scope="fragment")
+    except StreamlitAPIException: st.rerun()
+
+# Selezione multipla: una casella per riga con chiave legata all'id (resta giusta
+# anche quando la lista si aggiorna) e un'unica azione in_ su tutti gli id spuntati
+def bulk_selected(prefix, ids):
+    return [i for i in ids if st.session_state.get(f"{prefix}_{i}")]
+
+def bulk_bar(prefix, ids, label):
+    sel = bulk_selected(prefix, ids)
+    all_on = bool(ids) and len(sel) == len(ids)
+    c1, c2 = st.columns(2)
+    c1.button("Deseleziona tutto" if all_on else "Seleziona tutto", key=f"{prefix}_all",
+              on_click=lambda: st.session_state.update({f"{prefix}_{i}": not all_on for i in ids}))
+    go = c2.button(f"{label} ({len(sel)})", key=f"{prefix}_go", type="primary", disabled=not sel)
+    return sel if go else []
+
+def bulk_clear(prefix, ids):
+    for i in ids: st.session_state.pop(f"{prefix}_{i}", None)
+
+def mat_fornisci(ids):
+    db_update("material_requests", {"status": "ARCHIVED", "fornito_il": datetime.now().isoformat(timespec="minutes")},
+              [("in_", "id", ids), ("eq", "status", "PENDING")])
+
+# Data di fornitura: colonna fornito_il (le richieste vecchie la hanno già nel testo)
+def fornito_label(r):
+    return f" il {to_dt(pd.Series([r['fornito_il']])).iloc[0].strftime('%d/%m/%Y %H:%M')}" if pd.notna(r.get('fornito_il')) else ""
+
+@st.fragment(run_every=LIVE_EVERY)
+def live_materiali(filter_loc):
+    live_feedback()
+    flt = [("eq", "status", "PENDING")]
+    if filter_loc != "TUTTI": flt.append(("eq", "location", filter_loc))
+    df_reqs = get_df("material_requests", "id,username,location,request_date,item_list,visto", flt, order="request_date", desc=True) # Carico
+    live_notify(f"live_mat_{filter_loc}", df_reqs, "Richieste materiale")
+    mark_seen("material_requests", df_reqs)
+    if not df_reqs.empty:
+        ids = [int(i) for i in df_reqs['id']]
+        c1, c2 = st.columns([3, 1])
+        c1.write(f"Trovate **{len(df_reqs)}** richieste.")
+        multi = c2.toggle("☑️ Selezione multipla", key="mat_multi")
+        if multi:
+            sel = bulk_bar("mat_sel", ids, "✅ SEGNA COME FORNITE")
+            if sel:
+                mat_fornisci(sel); bulk_clear("mat_sel", sel)
+                live_rerun(f"{len(sel)} richieste archiviate.")
+        for _, r in df_reqs.iterrows():
+            loc_display = r['location'] if pd.notna(r['location']) else "Nessuna postazione"
+            with st.container():
+                st.markdown(f"""<div class='req-card'><b>👷 {r['username']}</b> presso <b>📍 {loc_display}</b><br>📅 {r['request_date'][:10]}<br><hr style='margin:5px 0'>🛒 <b>Lista:</b><br>{r['item_list']}</div>""", unsafe_allow_html=True)
+                if multi: st.checkbox("Seleziona", key=f"mat_sel_{r['id']}")
+                elif st.button("✅ SEGNA COME FORNITO", key=f"mat_ok_{r['id']}"):
+                    mat_fornisci([int(r['id'])])
+                    live_rerun("Archiviata!")
+    else: st.info("Nessuna richiesta.")
+    st.caption(f"🔄 Aggiornato alle {datetime.now().strftime('%H:%M:%S')}")
+
+@st.fragment(run_every=LIVE_EVERY)
+def live_segnalazioni():
+    live_feedback()
+    df_iss = get_df("issues", "id,location,username,timestamp,description,image_url,thumb_url,image_status,image_error,visto", [("eq", "status", "APERTA")], order="timestamp", desc=True) # Carico
+    live_notify("live_iss", df_iss, "Segnalazioni")
+    mark_seen("issues", df_iss)
+    if not df_iss.empty:
+        ids = [int(i) for i in df_iss['id']]
+        multi = st.toggle("☑️ Selezione multipla", key="iss_multi")
+        if multi:
+            sel = bulk_bar("iss_sel", ids, "✅ RISOLVI SELEZIONATE")
+            if sel:
+                db_update("issues", {"status": "RISOLTO"}, [("in_", "id", sel)]); bulk_clear("iss_sel", sel)
+                live_rerun(f"{len(sel)} segnalazioni risolte.")
+        for _, r in df_iss.iterrows():
+            with st.container():
+                st.markdown(f"<div class='issue-card'><b>📍 {r['location']}</b> | 👷 {r['username']}<br>📅 {r['timestamp'][:16]}<br><br>📝 {r['description']}</div>", unsafe_allow_html=True)
+                if r.get('image_status') == 'PENDING':
+                    if datetime.now() - pd.to_datetime(r['timestamp']).replace(tzinfo=None) > UPLOAD_STALE: st.warning("⚠️ La foto non è mai arrivata.")
+                    else: st.caption("📸 Foto in caricamento...")
+                elif r.get('image_status') == 'ERRORE':
+                    st.error(f"⚠️ Caricamento foto fallito: {r.get('image_error') or ''}")
+                if r.get('image_url'):
+                    # Miniatura in lista, foto intera solo se richiesta
+                    st.image(r['thumb_url'] if pd.notna(r.get('thumb_url')) else r['image_url'], width=300, caption="📸 Foto Cantiere")
+                    if pd.notna(r.get('thumb_url')) and st.toggle("🔍 Foto originale", key=f"full_{r['id']}"):
+                        st.image(r['image_url'], use_container_width=True)
+                if multi: st.checkbox("Seleziona", key=f"iss_sel_{r['id']}")
+                elif st.button("✅ RISOLVI", key=f"s_{r['id']}"):
+                    db_update("issues", {"status": "RISOLTO"}, [("eq", "id", r['id'])])
+                    live_rerun("Segnalazione risolta.")
+    else: st.info("Nessuna segnalazione aperta.")
+    st.caption(f"🔄 Aggiornato alle {datetime.now().strftime('%H:%M:%S')}")
+
+# ------------------------------------------------------------------------------
+# PREFETCH: i dati indipendenti di una pagina partono tutti insieme
+# page_jobs dichiara cosa serve alla pagina; un pool di thread del processo lo
+# scarica in parallelo e riempie le cache di processo (TableCache, mirror,
+# anagrafiche), da cui il codice della pagina poi legge come sempre. La pagina
+# costa la query più lenta invece della somma. Oltre PREFETCH_TIMEOUT non
+# aspetto: la pagina rilegge da sé e, se la fetch è ancora in volo, la attende
+# (single-flight) invece di duplicarla. I thread toccano solo le cache di
+# processo, mai sessione o elementi: niente contesto dello script, come gli upload.
+# ------------------------------------------------------------------------------
+PREFETCH_WORKERS = 8
+PREFETCH_TIMEOUT = 10
+
+@st.cache_resource
+def get_prefetch_pool():
+    return ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+# Le chiamate al backend fatte dal pool finiscono nella traccia del rerun che le ha chieste
+def _traced(tr, job):
+    _trace_local.trace = tr
+    try: return job()
+    finally: _trace_local.trace = None
+
+# Dal pool stesso si esegue in sequenza: un job che aspetta altri job del pool può bloccarlo
+def run_parallel(jobs, timeout=PREFETCH_TIMEOUT):
+    if len(jobs) < 2 or threading.current_thread().name.startswith("prefetch"): return [j() for j in jobs]
+    tr = getattr(_trace_local, "trace", None)
+    futs = [get_prefetch_pool().submit(_traced, tr, j) for j in jobs]
+    return [f.result(timeout=timeout) for f in futs]
+
+def page_jobs(page, username=None):
+    ss = st.session_state
+    jobs = []
+    if username is None:
+        # Badge della sidebar, calcolati a fine pagina
+        jobs += [lambda t=t: unread_count(t) for t in ("material_requests", "issues", "logs")]
+    if page == "📢 Bacheca & News": jobs.append(bacheca_attivi)
+    elif page == "📢 Bacheca": jobs.append(lambda: bacheca_attivi(username, "titolo,messaggio,data_pubblicazione"))
+    elif page == "📦 Richiesta Materiale": jobs.append(lambda: get_mirror("material_requests").refresh())
+    elif page == "👥 Staff & Cantieri": jobs += [lambda: get_df("users"), lambda: get_df("cantieri")]
+    elif page == "⚠️ Segnalazioni": jobs.append(lambda: get_mirror("issues").refresh())
+    elif page == "🗺️ Mappe GPS": jobs.append(lambda: get_mirror("logs").refresh())
+    elif page == "📊 Report Ore":
+        jobs += [lambda: get_mirror("logs").refresh(), month_options]
+        # Totale del mese già scelto (dal secondo giro in poi i widget hanno un valore),
+        # solo in modalità Mese: il Giorno non usa il riepilogo mensile
+        if ss.get("rep_mode", "Mese") == "Mese" and ss.get("rm") and ss.get("ru") and ss.get("rl"):
+            (t0, t1), fu, fl = month_bounds(ss.rm), ss.ru, ss.rl
+            jobs.append(lambda: rollup_df(t0[:10], t1[:10], None if fu == "TUTTI" else fu, None if fl == "TUTTE" else fl))
+    elif page == "🗓️ Calendario": jobs.append(month_options)
+    return jobs
+
+def prefetch(jobs):
+    if not db: return
+    tr = getattr(_trace_local, "trace", None)
+    futs = [get_prefetch_pool().submit(_traced, tr, j) for j in jobs]
+    # Anagrafiche da qui: le sue tre query vanno a loro volta nel pool
+    ref_data()
+    wait(futs, timeout=PREFETCH_TIMEOUT)
 
 # --- INIT SESSIONE ---
 if 'user' not in st.session_state: st.session_state.user = None
 if 'msg_feedback' not in st.session_state: st.session_state.msg_feedback = None
+trace = trace_begin()
 
 # Gestione Logo
-if os.path.exists("logo.png"):
-    c_logo, _ = st.columns([1, 4])
-    with c_logo: st.image("logo.png", width=250)
-else:
+c_logo, _ = st.columns([1, 4])
+with c_logo: has_logo = show_logo(250)
+if not has_logo:
     st.markdown("<h1 style='text-align: center; color: #2e7d32;'>CHEMIFOL</h1>", unsafe_allow_html=True)
 
 # ==============================================================================
@@ -163,9 +1428,9 @@ if st.session_state.user is None:
     if "u_persist" in qp:
         u_saved = qp["u_persist"]
         try:
-            res = supabase.table("users").select("*").eq("username", u_saved).execute()
-            if res.data:
-                st.session_state.user = res.data[0]
+            prof = user_profile(u_saved)
+            if prof:
+                st.session_state.user = prof
                 st.rerun()
         except: pass
 
@@ -182,9 +1447,9 @@ if not st.session_state.user:
             
             if st.form_submit_button("ENTRA"):
                 try:
-                    res = supabase.table("users").select("*").eq("username", u).eq("password", p).execute()
-                    if res.data:
-                        st.session_state.user = res.data[0]
+                    rows, _ = db.select("users", PROFILE_COLS, [("eq", "username", u), ("eq", "password", p)])
+                    if rows:
+                        st.session_state.user = rows[0]
                         if resta_collegato: st.query_params["u_persist"] = u
                         else: st.query_params.clear()
                         st.rerun()
@@ -196,6 +1461,8 @@ if not st.session_state.user:
 
 else:
     # --- UTENTE LOGGATO ---
+    import pandas as pd
+    import numpy as np
     user = st.session_state.user
     u_curr = user['username']
     name_display = "Mimmo Folda" if u_curr == 'mimmo' else user['nome_completo']
@@ -212,7 +1479,7 @@ else:
             if st.form_submit_button("SALVA E ACCEDI"):
                 if p1 and p1 == p2:
                     try:
-                        supabase.table("users").update({"password": p1, "pwd_changed": 1}).eq("username", u_curr).execute()
+                        db_update("users", {"password": p1, "pwd_changed": 1}, [("eq", "username", u_curr)])
                         st.session_state.user = None
                         st.query_params.clear()
                         st.success("Password aggiornata!"); time.sleep(1); st.rerun()
@@ -229,9 +1496,6 @@ else:
             st.markdown(f"## 👷 {name_display}")
             st.divider()
             
-            # Conteggi (calcolati dopo per velocità, o rimossi per ottimizzazione)
-            # Qui li lascio semplici
-            
             # Menu
             m_bach = "📢 Bacheca & News"
             m_mat = "📦 Richiesta Materiale"
@@ -243,11 +1507,18 @@ else:
             m_sec = "🔐 Sicurezza"
             
             choice = st.radio("Navigazione:", [m_bach, m_mat, m_gest, m_seg, m_map, m_rep, m_cal, m_sec])
+            # Badge riempiti a fine pagina, dopo aver segnato come visto ciò che è stato mostrato
+            badge_slot = st.empty()
             st.divider()
             if st.button("Esci"): 
                 st.session_state.user = None
                 st.query_params.clear()
                 st.rerun()
+            debug_slot = st.empty()
+        trace.page = choice
+        trace_section("prefetch")
+        prefetch(page_jobs(choice))
+        trace_section(choice)
 
         # Feedback Message Handler
         if st.session_state.msg_feedback:
@@ -265,34 +1536,33 @@ else:
             durata = st.slider("Giorni validità", 1, 60, 7)
             if st.button("PUBBLICA ANNUNCIO"):
                 if titolo and msg:
-                    dest_str = "TUTTI" if "TUTTI" in destinatari_sel else ",".join(destinatari_sel)
+                    dest = ["TUTTI"] if "TUTTI" in destinatari_sel or not destinatari_sel else destinatari_sel
                     scad = datetime.now() + timedelta(days=durata)
                     try:
-                        supabase.table("bacheca").insert({
-                            "titolo": titolo, "messaggio": msg, "destinatario": dest_str,
+                        db_insert("bacheca", {
+                            "titolo": titolo, "messaggio": msg, "destinatario": ",".join(dest), "destinatari": dest,
                             "data_pubblicazione": datetime.now().isoformat(),
                             "data_scadenza": scad.isoformat()
-                        }).execute()
+                        })
                         st.success("Pubblicato!"); time.sleep(0.5); st.rerun()
                     except: st.error("Errore.")
                 else: st.error("Compila tutto.")
             
             st.divider()
             st.subheader("Annunci Attivi")
-            df_b = get_df("bacheca") # Carico DOPO azione
+            bacheca_purge()
+            df_b = bacheca_attivi() # Carico DOPO azione
             if not df_b.empty:
-                df_b['data_scadenza'] = pd.to_datetime(df_b['data_scadenza'])
-                df_b = df_b[df_b['data_scadenza'] > datetime.now()].sort_values('data_pubblicazione', ascending=False)
+                df_b['data_scadenza'] = to_dt(df_b['data_scadenza'])
                 for _, a in df_b.iterrows():
                     st.info(f"[{a['destinatario']}] **{a['titolo']}**: {a['messaggio']} (Scade: {a['data_scadenza'].strftime('%d/%m')})")
                     if st.button("🗑️", key=f"del_b_{a['id']}"): 
-                        supabase.table("bacheca").delete().eq("id", a['id']).execute(); st.rerun()
+                        db_delete("bacheca", [("eq", "id", a['id'])]); st.rerun()
             st.markdown("</div>", unsafe_allow_html=True)
 
         # --- ADMIN: MATERIALI ---
         elif choice == m_mat:
             st.title("📦 Richieste Materiale")
-            supabase.table("material_requests").update({"visto": 1}).eq("visto", 0).execute()
             
             mode_mat = st.radio("Filtro:", ["DA FORNIRE (Pending)", "ARCHIVIO (Forniti)"], horizontal=True)
             if mode_mat == "DA FORNIRE (Pending)":
@@ -300,36 +1570,30 @@ else:
                 cantieri_list = ["TUTTI"] + get_all_cantieri()
                 filter_loc = st.selectbox("📍 Filtra per Postazione/Cantiere:", cantieri_list)
                 
-                df_reqs = get_df("material_requests") # Carico
-                if not df_reqs.empty:
-                    df_reqs = df_reqs[df_reqs['status'] == 'PENDING']
-                    if filter_loc != "TUTTI": df_reqs = df_reqs[df_reqs['location'] == filter_loc]
-                    df_reqs = df_reqs.sort_values('request_date', ascending=False)
-                    
-                    st.write(f"Trovate **{len(df_reqs)}** richieste.")
-                    for _, r in df_reqs.iterrows():
-                        loc_display = r['location'] if pd.notna(r['location']) else "Nessuna postazione"
-                        with st.container():
-                            st.markdown(f"""<div class='req-card'><b>👷 {r['username']}</b> presso <b>📍 {loc_display}</b><br>📅 {r['request_date'][:10]}<br><hr style='margin:5px 0'>🛒 <b>Lista:</b><br>{r['item_list']}</div>""", unsafe_allow_html=True)
-                            if st.button("✅ SEGNA COME FORNITO", key=f"mat_ok_{r['id']}"):
-                                # FIX DATA FORNITURA
-                                now_str = datetime.now().strftime("%d/%m/%Y %H:%M")
-                                new_txt = f"{r['item_list']} \n\n[✅ FORNITO IL: {now_str}]"
-                                supabase.table("material_requests").update({"status": "ARCHIVED", "item_list": new_txt}).eq("id", r['id']).execute()
-                                st.session_state.msg_feedback = "Archiviata!"; st.rerun()
-                else: st.info("Nessuna richiesta.")
+                live_materiali(filter_loc)
                 st.markdown("</div>", unsafe_allow_html=True)
             else:
                 st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
-                df_arch = get_df("material_requests")
+                df_arch = pager("arch_mat", "material_requests", "id,username,location,request_date,item_list,fornito_il", [("eq", "status", "ARCHIVED")], "request_date")
                 if not df_arch.empty:
-                    df_arch = df_arch[df_arch['status'] == 'ARCHIVED'].sort_values('request_date', ascending=False)
+                    ids = [int(i) for i in df_arch['id']]
+                    multi = st.toggle("☑️ Selezione multipla", key="arch_multi")
+                    if multi:
+                        sel = bulk_bar("arch_sel", ids, "❌ ELIMINA SELEZIONATE")
+                        if sel:
+                            delete_history("material_requests", sel); bulk_clear("arch_sel", sel)
+                            st.session_state.msg_feedback = f"{len(sel)} richieste eliminate."; st.rerun()
                     for _, r in df_arch.iterrows():
                         loc_display = r['location'] if pd.notna(r['location']) else "N/D"
-                        with st.expander(f"✅ {r['request_date'][:10]} - {r['username']} @ {loc_display}"):
+                        head = f"✅ {r['request_date'][:10]} - {r['username']} @ {loc_display}"
+                        if multi:
+                            st.checkbox(head, key=f"arch_sel_{r['id']}")
+                            continue
+                        with st.expander(head):
                             st.write(f"**Materiale:** {r['item_list']}")
+                            if pd.notna(r.get('fornito_il')): st.caption(f"✅ Fornito{fornito_label(r)}")
                             if st.button("❌ ELIMINA", key=f"del_arch_mat_{r['id']}"):
-                                supabase.table("material_requests").delete().eq("id", r['id']).execute(); st.rerun()
+                                delete_history("material_requests", [r['id']]); st.rerun()
                 st.markdown("</div>", unsafe_allow_html=True)
 
         # --- ADMIN: GESTIONE ---
@@ -344,7 +1608,7 @@ else:
                 nn = c2.text_input("Nome Completo")
                 if st.button("CREA DIPENDENTE"):
                     try:
-                        supabase.table("users").insert({"username": nu.lower(), "password": "1234", "role": "user", "nome_completo": nn}).execute()
+                        db_insert("users", {"username": nu.lower(), "password": "1234", "role": "user", "nome_completo": nn})
                         st.success("Creato!"); time.sleep(0.5); st.rerun()
                     except: st.error("Errore.")
                 
@@ -353,118 +1617,168 @@ else:
                 
                 u_del = st.selectbox("Utente da eliminare", ["..."] + get_all_staff())
                 if u_del != "..." and st.button("ELIMINA DIPENDENTE"):
-                    supabase.table("users").delete().eq("username", u_del).execute()
-                    supabase.table("assignments").delete().eq("username", u_del).execute()
+                    db_delete("users", [("eq", "username", u_del)])
+                    db_delete("assignments", [("eq", "username", u_del)])
                     st.success("Eliminato."); time.sleep(0.5); st.rerun()
                 st.markdown("</div>", unsafe_allow_html=True)
 
             with tab_loc:
                 st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
                 nl = st.text_input("Nuovo Cantiere")
+                g1, g2, g3 = st.columns(3)
+                n_lat = g1.number_input("Latitudine", value=None, format="%.6f", key="nl_lat")
+                n_lon = g2.number_input("Longitudine", value=None, format="%.6f", key="nl_lon")
+                n_rag = g3.number_input("Raggio (m)", min_value=20, value=GEO_RAGGIO_M, step=50, key="nl_rag")
                 if st.button("AGGIUNGI CANTIERE"):
                     try:
-                        supabase.table("cantieri").insert({"nome_cantiere": nl, "attivo": 1}).execute()
+                        db_insert("cantieri", {"nome_cantiere": nl, "attivo": 1, "lat": n_lat, "lon": n_lon, "raggio_m": n_rag})
                         st.success("Aggiunto!"); time.sleep(0.5); st.rerun()
                     except: st.error("Errore.")
                 
                 st.divider()
-                st.dataframe(get_df("cantieri"), use_container_width=True)
+                df_cant = get_df("cantieri")
+                st.dataframe(df_cant, use_container_width=True)
+
+                # Posizione e raggio usati per segnalare le timbrature fuori area
+                st.subheader("📍 Posizione Cantiere")
+                c_pos = st.selectbox("Cantiere", get_all_cantieri(), key="c_pos")
+                if c_pos:
+                    cur = df_cant[df_cant['nome_cantiere'] == c_pos].iloc[0] if not df_cant.empty and 'lat' in df_cant.columns else {}
+                    g1, g2, g3 = st.columns(3)
+                    e_lat = g1.number_input("Latitudine", value=float(cur['lat']) if pd.notna(cur.get('lat')) else None, format="%.6f", key=f"e_lat_{c_pos}")
+                    e_lon = g2.number_input("Longitudine", value=float(cur['lon']) if pd.notna(cur.get('lon')) else None, format="%.6f", key=f"e_lon_{c_pos}")
+                    e_rag = g3.number_input("Raggio (m)", min_value=20, value=int(cur['raggio_m']) if pd.notna(cur.get('raggio_m')) else GEO_RAGGIO_M, step=50, key=f"e_rag_{c_pos}")
+                    if st.button("SALVA POSIZIONE"):
+                        db_update("cantieri", {"lat": e_lat, "lon": e_lon, "raggio_m": e_rag}, [("eq", "nome_cantiere", c_pos)])
+                        st.success("Salvato."); time.sleep(0.5); st.rerun()
                 
                 c_del = st.selectbox("Cantiere da archiviare", ["..."] + get_all_cantieri())
+                if c_del != "..." and ref_data().users_at(c_del):
+                    st.caption(f"Assegnato a: {', '.join(sorted(ref_data().users_at(c_del)))} (le assegnazioni verranno rimosse)")
                 if c_del != "..." and st.button("ARCHIVIA CANTIERE"):
                     # FIX SOFT DELETE
-                    supabase.table("cantieri").update({"attivo": 0}).eq("nome_cantiere", c_del).execute()
-                    supabase.table("assignments").delete().eq("location", c_del).execute()
+                    db_update("cantieri", {"attivo": 0}, [("eq", "nome_cantiere", c_del)])
+                    db_delete("assignments", [("eq", "location", c_del)])
                     st.success("Archiviato."); time.sleep(0.5); st.rerun()
                 st.markdown("</div>", unsafe_allow_html=True)
 
             with tab_ass:
                 st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
-                su = st.selectbox("Dipendente", get_all_staff())
-                # Carico dati freschi
-                df_ass = get_df("assignments")
-                all_cantieri = get_all_cantieri()
-                curr_ass = []
-                if not df_ass.empty and 'username' in df_ass.columns:
-                    curr_ass = df_ass[df_ass['username'] == su]['location'].tolist()
-                    curr_ass = [c for c in curr_ass if c in all_cantieri]
+                ref = ref_data()
+                su = st.selectbox("Dipendente", ref.staff)
+                all_cantieri = ref.cantieri
+                curr_ass = [c for c in ref.locations(su) if c in ref.active]
                 
                 na = st.multiselect("Assegna", all_cantieri, default=curr_ass)
                 
                 if st.button("SALVA ASSEGNAZIONI"):
-                    supabase.table("assignments").delete().eq("username", su).execute()
-                    if na: supabase.table("assignments").insert([{"username": su, "location": l} for l in na]).execute()
+                    db_delete("assignments", [("eq", "username", su)])
+                    if na: db_insert("assignments", [{"username": su, "location": l} for l in na])
                     st.success("Salvato."); time.sleep(0.5); st.rerun()
                 st.markdown("</div>", unsafe_allow_html=True)
 
         # --- ADMIN: SEGNALAZIONI ---
         elif choice == m_seg:
             st.title("⚠️ Segnalazioni")
-            supabase.table("issues").update({"visto": 1}).eq("visto", 0).execute()
             
             mode = st.radio("Vista:", ["APERTE", "RISOLTE"], horizontal=True)
-            df_iss = get_df("issues") # Carico
             
             if mode == "APERTE":
-                if not df_iss.empty:
-                    df_iss = df_iss[df_iss['status'] == 'APERTA'].sort_values('timestamp', ascending=False)
-                    for _, r in df_iss.iterrows():
-                        with st.container():
-                            st.markdown(f"<div class='issue-card'><b>📍 {r['location']}</b> | 👷 {r['username']}<br>📅 {r['timestamp'][:16]}<br><br>📝 {r['description']}</div>", unsafe_allow_html=True)
-                            if r.get('image_url'): st.image(r['image_url'], width=300, caption="📸 Foto Cantiere")
-                            if st.button("✅ RISOLVI", key=f"s_{r['id']}"):
-                                supabase.table("issues").update({"status": "RISOLTO"}).eq("id", r['id']).execute()
-                                st.rerun()
+                live_segnalazioni()
             else:
                 st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
+                df_iss = pager("iss_ris", "issues", "id,timestamp,location,username,description", [("eq", "status", "RISOLTO")], "timestamp")
                 if not df_iss.empty:
-                    df_iss = df_iss[df_iss['status'] == 'RISOLTO'].sort_values('timestamp', ascending=False)
                     st.dataframe(df_iss[['timestamp', 'location', 'username', 'description']], use_container_width=True)
                 st.markdown("</div>", unsafe_allow_html=True)
 
         # --- ADMIN: GPS ---
         elif choice == m_map:
             st.title("🗺️ Tracciamento GPS")
-            supabase.table("logs").update({"visto": 1}).eq("visto", 0).execute()
             
             st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
             c1, c2, c3 = st.columns(3)
             fu = c1.selectbox("Utente", ["TUTTI"] + get_all_staff())
             fl = c2.selectbox("Luogo", ["TUTTE"] + get_all_cantieri())
-            fd = c3.date_input("Data Specifica", value=datetime.now())
+            gps_mode = c3.radio("Periodo", ["Giorno", "Intervallo"], horizontal=True, key="gps_mode")
+            if gps_mode == "Giorno":
+                fd = c3.date_input("Data Specifica", value=datetime.now())
+                t0, t1 = day_bounds(fd)
+            else:
+                rng = c3.date_input("Dal / Al", value=(datetime.now() - timedelta(days=7), datetime.now()), key="gps_rng")
+                t0, t1 = day_bounds(rng[0])[0], day_bounds(rng[-1])[1]
             
-            df = get_df("logs")
+            flt = [("neq", "gps_lat", 0), ("gte", "start_time", t0), ("lt", "start_time", t1)]
+            if fu != "TUTTI": flt.append(("eq", "username", fu))
+            if fl != "TUTTE": flt.append(("eq", "location", fl))
+            df = get_history("logs", "id,username,location,start_time,gps_lat,gps_lon,gps_lat_out,gps_lon_out,visto", flt, order="start_time", desc=True)
+            mark_seen("logs", df)
+            sites = get_sites()
+            flags = geofence(sites)
+            n_fuori = int(df['id'].isin(flags.index).sum()) if not df.empty else 0
+            if st.checkbox(f"Solo timbrature fuori area ({n_fuori})", key="gps_fuori"): df = df[df['id'].isin(flags.index)]
             if not df.empty:
-                df = df[df['gps_lat'] != 0]
-                if fu != "TUTTI": df = df[df['username'] == fu]
-                if fl != "TUTTE": df = df[df['location'] == fl]
-                df['start_time'] = pd.to_datetime(df['start_time'])
-                df = df[df['start_time'].dt.date == fd].sort_values('start_time', ascending=False)
-                
-                if not df.empty:
-                    for _, r in df.iterrows():
-                        o_in = r['start_time'].strftime('%H:%M')
-                        o_out = pd.to_datetime(r['end_time']).strftime('%H:%M') if pd.notna(r['end_time']) else "IN CORSO"
-                        
-                        with st.expander(f"📍 {r['username']} @ {r['location']} ({o_in} - {o_out})"):
-                            ci, co = st.columns(2)
-                            
-                            # INGRESSO
-                            ci.success(f"🟢 IN: {o_in}")
-                            ci.map(pd.DataFrame({'latitude': [float(r['gps_lat'])], 'longitude': [float(r['gps_lon'])]}), zoom=15)
-                            link_in = f"https://www.google.com/maps/search/?api=1&query={r['gps_lat']},{r['gps_lon']}"
-                            ci.markdown(f"<a href='{link_in}' target='_blank' class='map-link'>APRI MAPS INGRESSO</a>", unsafe_allow_html=True)
-
-                            # USCITA
-                            if pd.notna(r['end_time']):
-                                co.error(f"🔴 OUT: {o_out}")
-                                co.map(pd.DataFrame({'latitude': [float(r['gps_lat_out'])], 'longitude': [float(r['gps_lon_out'])]}), zoom=15)
-                                link_out = f"https://www.google.com/maps/search/?api=1&query={r['gps_lat_out']},{r['gps_lon_out']}"
-                                co.markdown(f"<a href='{link_out}' target='_blank' class='map-link'>APRI MAPS USCITA</a>", unsafe_allow_html=True)
-                            
-                            if st.button(f"Elimina Log", key=f"dm_{r['id']}"):
-                                supabase.table("logs").delete().eq("id", r['id']).execute(); st.rerun()
-                else: st.info("Nessun percorso.")
+                df['start_time'] = to_dt(df['start_time'])
+                deck, pts = gps_deck(df, flags, sites)
+                clustered = len(pts) > GPS_CLUSTER_MIN
+                st.caption(f"{len(pts)} turni" + (" · raggruppati per zona: seleziona un gruppo per vederne i turni" if clustered
+                           else " · ● ingresso, ○ uscita · seleziona un punto per il dettaglio"))
+                ev = st.pydeck_chart(deck, on_select="rerun", selection_mode="single-object", key=f"gps_map_{gps_mode}")
+                picked = {k: v[0] for k, v in (ev.selection.get("objects") or {}).items() if v}
+                if not clustered and len(pts['username'].unique()) <= len(GPS_PALETTE):
+                    st.markdown(" ".join(f"<span style='color:rgb{tuple(user_color(u))}'>●</span> {u}" for u in sorted(pts['username'].unique())), unsafe_allow_html=True)
+
+                # Dettaglio: solo il turno scelto (dal punto sulla mappa o dall'elenco)
+                if clustered:
+                    pts = pts[gps_cell(pts['lat'], pts['lon']) == picked["cluster"]["cella"]] if "cluster" in picked else pts.iloc[0:0]
+                labels = dict(zip(pts['id'], "📍 " + pts['username'] + " @ " + pts['location'] + " (" + pts['ora'] + ")" + pts['geo'].map(lambda g: " ⚠️" if g else "")))
+                map_pick = next((int(o["id"]) for k, o in picked.items() if k in ("in", "out")), None)
+                if map_pick is not None and map_pick != st.session_state.get("gps_pick_last"):
+                    st.session_state.gps_det = map_pick
+                st.session_state.gps_pick_last = map_pick
+                if st.session_state.get("gps_det") not in labels: st.session_state.gps_det = None
+                sel_id = None
+                if labels: sel_id = st.selectbox("Dettaglio turno", [None] + list(labels), format_func=lambda i: "—" if i is None else labels[i], key="gps_det")
+                if sel_id is not None:
+                    det = get_history("logs", "id,username,location,start_time,end_time,gps_lat,gps_lon,gps_lat_out,gps_lon_out", [("eq", "id", sel_id)])
+                    if not det.empty:
+                        r = det.iloc[0]
+                        o_in = to_dt(pd.Series([r['start_time']])).iloc[0].strftime('%H:%M')
+                        o_out = to_dt(pd.Series([r['end_time']])).iloc[0].strftime('%H:%M') if pd.notna(r['end_time']) else "IN CORSO"
+                        if sel_id in flags.index:
+                            f = flags.loc[sel_id]
+                            st.warning("⚠️ Fuori area: " + "; ".join(
+                                f"{nome} a {fmt_dist(f['dist_' + side])} dal cantiere"
+                                + (f" (vicino a {f['vicino_' + side]})" if f['vicino_' + side] and f['vicino_' + side] != r['location'] else "")
+                                for side, nome in (("in", "ingresso"), ("out", "uscita")) if f['fuori_' + side]))
+                        ci, co = st.columns(2)
+
+                        # INGRESSO
+                        ci.success(f"🟢 IN: {o_in}")
+                        link_in = f"https://www.google.com/maps/search/?api=1&query={r['gps_lat']},{r['gps_lon']}"
+                        ci.markdown(f"<a href='{link_in}' target='_blank' class='map-link'>APRI MAPS INGRESSO</a>", unsafe_allow_html=True)
+
+                        # USCITA
+                        if pd.notna(r['end_time']):
+                            co.error(f"🔴 OUT: {o_out}")
+                            link_out = f"https://www.google.com/maps/search/?api=1&query={r['gps_lat_out']},{r['gps_lon_out']}"
+                            co.markdown(f"<a href='{link_out}' target='_blank' class='map-link'>APRI MAPS USCITA</a>", unsafe_allow_html=True)
+
+                        if st.button(f"Elimina Log", key=f"dm_{r['id']}"):
+                            delete_history("logs", [r['id']])
+                            rollup_refresh(rollup_keys(det))
+                            st.session_state.pop("gps_det", None); st.rerun()
+
+                # Più turni in un colpo: gli stessi dell'elenco dettaglio, un solo delete
+                if labels and st.toggle("☑️ Selezione multipla", key="gps_multi"):
+                    st.session_state.gps_sel = [i for i in st.session_state.get("gps_sel", []) if i in labels]
+                    sel = [int(i) for i in st.multiselect("Turni da eliminare", list(labels), format_func=labels.get, key="gps_sel")]
+                    if sel and st.button(f"❌ ELIMINA SELEZIONATI ({len(sel)})", key="gps_del"):
+                        delete_history("logs", sel)
+                        rollup_refresh(rollup_keys(df[df['id'].isin(sel)]))
+                        st.session_state.pop("gps_sel", None); st.session_state.pop("gps_det", None)
+                        st.session_state.msg_feedback = f"{len(sel)} turni eliminati."; st.rerun()
+            else: st.info("Nessun percorso.")
             st.markdown("</div>", unsafe_allow_html=True)
 
         # --- ADMIN: REPORT ORE ---
@@ -472,64 +1786,116 @@ else:
             st.title("📊 Report Ore")
             st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
             col_mode, col_fil = st.columns([1, 3])
-            filter_mode = col_mode.radio("Filtra per:", ["Mese", "Giorno"], horizontal=True)
+            filter_mode = col_mode.radio("Filtra per:", ["Mese", "Giorno"], horizontal=True, key="rep_mode")
             c1, c2, c3 = st.columns(3)
             fu = c1.selectbox("Dipendente", ["TUTTI"] + get_all_staff(), key="ru")
             fl = c2.selectbox("Postazione", ["TUTTE"] + get_all_cantieri(), key="rl")
             
-            df = get_df("logs")
-            if not df.empty:
-                df = df[pd.notna(df['end_time'])].copy()
-                df['start_time'] = pd.to_datetime(df['start_time'])
-                df['end_time'] = pd.to_datetime(df['end_time'])
-                df['Ore'] = ((df['end_time'] - df['start_time']).dt.total_seconds() / 3600).round(2)
-                
-                # --- DOWNLOAD EXCEL ---
-                try:
-                    df_xlsx = to_excel(df[['username', 'location', 'start_time', 'end_time', 'Ore']])
-                    st.download_button("📥 SCARICA EXCEL (.xlsx)", data=df_xlsx, file_name="report.xlsx")
-                except: st.warning("Excel non disp.")
-                
+            mesi = month_options()
+            if mesi:
                 if filter_mode == "Mese":
-                    fm = c3.selectbox("Seleziona Mese", df['start_time'].dt.strftime('%m-%Y').unique(), key="rm")
-                    df = df[df['start_time'].dt.strftime('%m-%Y') == fm]
+                    fm = c3.selectbox("Seleziona Mese", mesi, key="rm")
+                    t0, t1 = month_bounds(fm)
                 else:
                     fd = c3.date_input("Seleziona Giorno", value=datetime.now())
-                    df = df[df['start_time'].dt.date == fd]
+                    t0, t1 = day_bounds(fd)
+                
+                flt = [("not_is", "end_time", "null"), ("gte", "start_time", t0), ("lt", "start_time", t1)]
+                if fu != "TUTTI": flt.append(("eq", "username", fu))
+                if fl != "TUTTE": flt.append(("eq", "location", fl))
+                trace_section("Report Ore: turni")
+                df = get_history("logs", "id,username,location,start_time,end_time", flt, order="start_time")
+                if df.empty: df = pd.DataFrame(columns=['id', 'username', 'location', 'start_time', 'end_time'])
+                df['start_time'] = to_dt(df['start_time'])
+                df['end_time'] = to_dt(df['end_time'])
+                df['Ore'] = shift_hours(df)
+                flags = geofence()
+                if flags.index.isin(df['id']).any(): st.caption(f"⚠️ {int(df['id'].isin(flags.index).sum())} turni con timbrature fuori area (colonna GPS)")
                 
-                if fu != "TUTTI": df = df[df['username'] == fu]
-                if fl != "TUTTE": df = df[df['location'] == fl]
+                # Tabella Report: un solo widget, la colonna ❌ seleziona i turni da eliminare
+                tab = pd.DataFrame({
+                    "❌": False,
+                    "CHI": "👷 " + df['username'].astype(str),
+                    "DOVE": "📍 " + df['location'].astype(str),
+                    "DATA": df['start_time'].dt.strftime('%d/%m'),
+                    "ORARI": df['start_time'].dt.strftime('%H:%M') + " - " + df['end_time'].dt.strftime('%H:%M'),
+                    "ORE": df['Ore'],
+                    "GPS": [("⚠️ " + geofence_label(flags, i)) if i in flags.index else "" for i in df['id']],
+                }, index=df['id'])
+                ed = st.data_editor(
+                    tab, hide_index=True, use_container_width=True,
+                    disabled=["CHI", "DOVE", "DATA", "ORARI", "ORE", "GPS"],
+                    column_config={
+                        "❌": st.column_config.CheckboxColumn("❌", help="Seleziona per eliminare", width="small"),
+                        "ORE": st.column_config.NumberColumn("ORE", format="%.2f"),
+                    },
+                    key=f"rep_tab_{st.session_state.get('rep_ver', 0)}",
+                )
+                sel = [int(i) for i in ed.index[ed["❌"]]]
+                if sel and st.button(f"❌ ELIMINA SELEZIONATI ({len(sel)})"):
+                    delete_history("logs", sel)
+                    rollup_refresh(rollup_keys(df[df['id'].isin(sel)]))
+                    # Nuova chiave = tabella ripulita dalla selezione precedente
+                    st.session_state.rep_ver = st.session_state.get('rep_ver', 0) + 1
+                    st.rerun()
+                trace_section("Report Ore: totale")
+                tot = rollup_df(t0[:10], t1[:10], None if fu == "TUTTI" else fu, None if fl == "TUTTE" else fl)
+                st.success(f"TOTALE: {(tot['ore'].sum() if not tot.empty else 0):.2f} ore")
                 
-                # Tabella Report HTML
-                st.markdown("""<table class='report-table'><tr><th>CHI</th><th>DOVE</th><th>DATA</th><th>ORARI</th><th>ORE</th><th></th></tr>""", unsafe_allow_html=True)
-                for _, r in df.iterrows():
-                    c_1, c_2, c_3, c_4, c_5, c_6 = st.columns([2,2,1,2,1,1])
-                    c_1.write(f"👷 {r['username']}"); c_2.write(f"📍 {r['location']}")
-                    c_3.write(r['start_time'].strftime('%d/%m')); c_4.write(f"{r['start_time'].strftime('%H:%M')} - {r['end_time'].strftime('%H:%M')}")
-                    c_5.write(f"**{r['Ore']}**")
-                    if c_6.button("❌", key=f"dh_{r['id']}"):
-                        supabase.table("logs").delete().eq("id", r['id']).execute(); st.rerun()
-                st.markdown("</table>", unsafe_allow_html=True)
-                st.success(f"TOTALE: {df['Ore'].sum():.2f} ore")
+                # --- DOWNLOAD EXCEL (solo su richiesta, con i filtri attivi) ---
+                trace_section("Report Ore: excel")
+                with st.expander("📥 Esporta Excel"):
+                    periodo = st.radio("Periodo:", ["Selezione attuale", "Intervallo date"], horizontal=True, key="xlsx_per")
+                    x_flt = flt
+                    if periodo == "Intervallo date":
+                        rng = st.date_input("Dal / Al", value=(datetime.now().replace(day=1), datetime.now()), key="xlsx_rng")
+                        if len(rng) == 2:
+                            x_flt = [f for f in flt if f[1] != "start_time"] + [("gte", "start_time", day_bounds(rng[0])[0]), ("lt", "start_time", day_bounds(rng[1])[1])]
+                    per_dip = st.checkbox("Un foglio per dipendente", key="xlsx_dip")
+                    x_key = (tuple(x_flt), per_dip)
+                    if st.button("PREPARA EXCEL"): st.session_state.xlsx_key = x_key
+                    if st.session_state.get("xlsx_key") == x_key:
+                        try:
+                            with st.spinner("Preparazione file..."):
+                                data = build_excel(x_key[0], per_dip, (get_mirror("logs").version, archive_version("logs")))
+                            st.download_button("📥 SCARICA EXCEL (.xlsx)", data=data, file_name="report.xlsx", on_click="ignore")
+                        except: st.warning("Excel non disp.")
             st.markdown("</div>", unsafe_allow_html=True)
 
         # --- ADMIN: CALENDARIO ---
         elif choice == m_cal:
             st.title("🗓️ Matrice")
             st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
-            su = st.selectbox("Dipendente", get_all_staff(), key="mu")
-            df = get_df("logs")
-            if not df.empty:
-                df = df[(df['username'] == su) & (pd.notna(df['end_time']))].copy()
-                if not df.empty:
-                    df['start_time'] = pd.to_datetime(df['start_time'])
-                    df['end_time'] = pd.to_datetime(df['end_time'])
-                    df['Giorno'] = df['start_time'].dt.day; df['Mese'] = df['start_time'].dt.strftime('%m-%Y')
-                    df['Ore'] = ((df['end_time'] - df['start_time']).dt.total_seconds() / 3600).round(2)
-                    sm = st.selectbox("Mese", df['Mese'].unique())
-                    piv = df[df['Mese'] == sm].pivot_table(index='location', columns='Giorno', values='Ore', aggfunc='sum', fill_value=0)
-                    piv['TOTALE'] = piv.sum(axis=1)
-                    st.dataframe(piv, use_container_width=True)
+            vista = st.radio("Vista:", ["Un dipendente", "Tutti i dipendenti"], horizontal=True, key="mat_vista")
+            su = st.selectbox("Dipendente", get_all_staff(), key="mu") if vista == "Un dipendente" else None
+            mesi = month_options()
+            if mesi:
+                sm = st.selectbox("Mese", mesi)
+                # Un solo cubo per mese: cambiare dipendente non rilegge nulla
+                cube = month_cube(sm)
+                if su is not None:
+                    piv = cube.loc[su] if not cube.empty and su in cube.index.get_level_values('username') else pd.DataFrame()
+                    piv = piv.loc[:, piv.any()] if not piv.empty else piv
+                    if not piv.empty: st.dataframe(piv.rename_axis(index="location", columns="Giorno"), use_container_width=True)
+                    else: st.info("Nessuna ora registrata nel mese.")
+                elif not cube.empty:
+                    tot = cube_staff(cube)
+                    names = ref_data().names
+                    c1, c2 = st.columns(2)
+                    c1.metric("Ore totali", f"{tot['TOTALE'].sum():.2f}")
+                    c2.metric("Dipendenti", len(tot))
+                    st.download_button("📥 SCARICA MATRICE (.xlsx)", data=cube_excel(sm), file_name=f"matrice_{sm}.xlsx", on_click="ignore")
+                    st.caption("Seleziona un dipendente per il dettaglio per postazione.")
+                    view = tot.rename_axis(index="Dipendente", columns="Giorno")
+                    view.insert(0, "Nome", [names.get(u, u) for u in view.index])
+                    ev = st.dataframe(view, use_container_width=True, on_select="rerun", selection_mode="single-row", key=f"mat_all_{sm}")
+                    rows = ev.selection.rows
+                    if rows:
+                        u = tot.index[rows[0]]
+                        st.subheader(f"👷 {names.get(u, u)}")
+                        det = cube.loc[u]
+                        st.dataframe(det.loc[:, det.any()].rename_axis(index="location", columns="Giorno"), use_container_width=True)
+                else: st.info("Nessuna ora registrata nel mese.")
             st.markdown("</div>", unsafe_allow_html=True)
 
         # --- ADMIN: SICUREZZA ---
@@ -539,22 +1905,66 @@ else:
             st.subheader("Admin")
             nap = st.text_input("Nuova Password Admin", type="password")
             if st.button("CAMBIA"):
-                supabase.table("users").update({"password": nap}).eq("username", "mimmo").execute()
+                db_update("users", {"password": nap}, [("eq", "username", "mimmo")])
                 st.success("OK")
             st.divider()
             st.subheader("Reset Staff")
             ur = st.selectbox("Dipendente", get_all_staff())
             if st.button("RESET A 1234"):
-                supabase.table("users").update({"password": "1234", "pwd_changed": 0}).eq("username", ur).execute()
+                db_update("users", {"password": "1234", "pwd_changed": 0}, [("eq", "username", ur)])
                 st.success("Fatto")
+            st.divider()
+            st.subheader("Riepilogo Ore")
+            st.caption("Ricalcola da zero il riepilogo giornaliero usato da Report Ore e Matrice.")
+            if st.button("RICOSTRUISCI RIEPILOGO"):
+                with st.spinner("Ricalcolo..."): n = rollup_backfill()
+                st.success(f"Fatto: {n} giornate.")
+            st.divider()
+            st.subheader("Timbrature Non Registrate")
+            errs = get_punch_queue().errors()
+            if not errs: st.caption("Nessuna: tutte le timbrature sono arrivate al database.")
+            for r in errs:
+                with st.expander(f"❌ {r['username']}: {punch_label(r)}"):
+                    st.caption(f"{r['attempts']} tentativi · {r['last_error']}")
+                    c1, c2 = st.columns(2)
+                    if c1.button("RIPROVA", key=f"pq_retry_{r['seq']}"): get_punch_queue().retry(r['seq']); st.rerun()
+                    if c2.button("SCARTA", key=f"pq_drop_{r['seq']}"): get_punch_queue().discard(r['seq']); st.rerun()
+            st.divider()
+            st.subheader("Archivio Storico")
+            arch = get_archive()
+            if arch is None:
+                st.caption("Configura [archivio] nei secrets (cartella ed eventuale bucket) per archiviare i mesi chiusi.")
+            else:
+                st.caption("Turni chiusi, richieste archiviate e segnalazioni risolte dei mesi vecchi passano in file compressi: "
+                           "restano visibili in Report Ore, GPS e archivi. Da fare una volta al mese (o con python archivio.py).")
+                for t, nome in (("logs", "Turni"), ("material_requests", "Richieste"), ("issues", "Segnalazioni")):
+                    idx = arch.index(t)
+                    st.write(f"**{nome}:** " + (f"{sum(m['righe'] for m in idx.values())} righe, {min(idx)} → {max(idx)}" if idx else "nessun mese archiviato"))
+                if not arch.durable:
+                    st.warning("⚠️ L'archivio è solo nella cartella locale del server: su un host effimero (es. Streamlit Cloud) "
+                               "sparisce al redeploy e lo storico andrebbe perso. Configura bucket in [archivio], "
+                               "oppure durevole = true se la cartella è su disco persistente.")
+                keep = st.number_input("Mesi recenti da lasciare attivi", min_value=1, max_value=24, value=3, key="arch_keep")
+                if st.button("ARCHIVIA MESI CHIUSI", disabled=not arch.durable):
+                    with st.spinner("Archiviazione..."):
+                        res = archive_compact(db, arch, int(keep), delete=lambda t, ids: db_delete(t, [("in_", "id", ids)]))
+                    for t in res: get_cold_cache().invalidate(t)
+                    st.success("Fatto: " + ", ".join(f"{t} {sum(m.values())}" for t, m in res.items()) + " righe archiviate.")
             st.markdown("</div>", unsafe_allow_html=True)
 
+        # Badge non letti nella sidebar
+        trace_section("badge")
+        badges = [(m_mat, unread_count("material_requests")), (m_seg, unread_count("issues")), (m_map, unread_count("logs"))]
+        html = "".join(f"<span class='nav-badge'>{m.split()[0]} {n}</span>" for m, n in badges if n)
+        if html: badge_slot.markdown(html, unsafe_allow_html=True)
+        trace_panel(debug_slot, trace_end(trace))
+
     # ------------------------------------------------------------------
     # AREA DIPENDENTE
     # ------------------------------------------------------------------
     else:
         with st.sidebar:
-            if os.path.exists("logo.png"): st.image("logo.png", width=150)
+            show_logo(150)
             st.markdown(f"### Ciao, {name_display}"); st.divider()
             menu_emp = st.radio("Vai a:", ["📢 Bacheca", "📦 Richiesta Materiale", "📍 Timbratore"])
             st.divider()
@@ -562,21 +1972,23 @@ else:
                 st.session_state.user = None
                 st.query_params.clear()
                 st.rerun()
+        trace.page = menu_emp
+        trace_section("prefetch")
+        prefetch(page_jobs(menu_emp, u_curr))
+        trace_section(menu_emp)
+
+        if st.session_state.msg_feedback:
+            st.success(st.session_state.msg_feedback); st.session_state.msg_feedback = None
+        if st.session_state.pop("balloons", False): st.balloons()
 
         # --- USER: BACHECA ---
         if menu_emp == "📢 Bacheca":
             st.title("📢 Bacheca Comunicazioni")
-            anns = get_df("bacheca")
+            bacheca_purge()
+            anns = bacheca_attivi(u_curr, "titolo,messaggio,data_pubblicazione")
             if not anns.empty:
-                anns['data_scadenza'] = pd.to_datetime(anns['data_scadenza'])
-                anns = anns[anns['data_scadenza'] > datetime.now()].sort_values('data_pubblicazione', ascending=False)
-                found = False
                 for _, m in anns.iterrows():
-                    dests = str(m['destinatario']).split(',')
-                    if "TUTTI" in dests or u_curr in dests:
-                        found = True
-                        st.markdown(f"<div class='bacheca-card'><span class='bacheca-title'>{m['titolo']}</span>{m['messaggio']}<div class='bacheca-meta'>Del: {str(m['data_pubblicazione'])[:10]}</div></div>", unsafe_allow_html=True)
-                if not found: st.info("Nessun avviso.")
+                    st.markdown(f"<div class='bacheca-card'><span class='bacheca-title'>{m['titolo']}</span>{m['messaggio']}<div class='bacheca-meta'>Del: {str(m['data_pubblicazione'])[:10]}</div></div>", unsafe_allow_html=True)
             else: st.info("Nessun avviso.")
 
         # --- USER: MATERIALI ---
@@ -586,20 +1998,17 @@ else:
             st.info("Usa questo modulo per richiedere prodotti, DPI o attrezzatura all'amministrazione.")
             
             with st.form("req_form"):
-                df_ass = get_df("assignments")
-                locs_avail = []
-                if not df_ass.empty and 'username' in df_ass.columns:
-                    locs_avail = df_ass[df_ass['username'] == u_curr]['location'].tolist()
+                locs_avail = ref_data().locations(u_curr)
                 
                 if locs_avail:
                     sel_loc = st.selectbox("Per quale cantiere/postazione?", locs_avail)
                     txt_mat = st.text_area("Elenco materiale richiesto (Specifica quantità)", height=150)
                     if st.form_submit_button("INVIA RICHIESTA"):
                         if txt_mat and sel_loc:
-                            supabase.table("material_requests").insert({
+                            db_insert("material_requests", {
                                 "username": u_curr, "location": sel_loc, "item_list": txt_mat,
                                 "request_date": datetime.now().isoformat(), "status": "PENDING", "visto": 0
-                            }).execute()
+                            })
                             st.success("Inviata!"); time.sleep(1); st.rerun()
                         else: st.error("Compila tutto.")
                 else:
@@ -608,37 +2017,40 @@ else:
             st.markdown("</div>", unsafe_allow_html=True)
             
             st.subheader("Le tue ultime richieste")
-            df_m = get_df("material_requests")
-            if not df_m.empty:
-                my_reqs = df_m[df_m['username'] == u_curr].sort_values('request_date', ascending=False).head(5)
+            my_reqs = get_df("material_requests", "location,request_date,item_list,status,fornito_il", [("eq", "username", u_curr)], order="request_date", desc=True, limit=5)
+            if not my_reqs.empty:
                 for _, r in my_reqs.iterrows():
-                    status_icon = "⏳ IN ATTESA" if r['status'] == 'PENDING' else "✅ FORNITO"
+                    status_icon = "⏳ IN ATTESA" if r['status'] == 'PENDING' else "✅ FORNITO" + fornito_label(r)
                     st.caption(f"{r['request_date'][:10]} - 📍 {r['location']} - {status_icon}")
                     st.text(r['item_list']); st.divider()
 
         # --- USER: TIMBRATORE ---
         elif menu_emp == "📍 Timbratore":
+            from streamlit_js_eval import get_geolocation
             st.title("📍 Gestione Turno")
-            df_logs = get_df("logs")
-            active = None
-            if not df_logs.empty:
-                active_logs = df_logs[(df_logs['username'] == u_curr) & (df_logs['end_time'].isna())]
-                if not active_logs.empty: active = active_logs.iloc[0]
+            try: active = open_shift(u_curr)
+            except:
+                active = None; st.warning("Server non raggiungibile: stato del turno non aggiornato.")
+            pend = get_punch_queue().pending(u_curr)
+            if pend:
+                slow = max(p['attempts'] for p in pend)
+                st.caption(f"⏳ {len(pend)} timbratura/e ricevute dal server, registrazione nel database in corso"
+                           + (" (database lento, riprovo da solo)" if slow >= 2 else ""))
+            for r in get_punch_queue().errors(u_curr):
+                st.error(f"❌ {punch_label(r)} non registrata: avvisa l'ufficio.")
 
             if active is not None:
                 st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
                 st.success(f"SEI A: **{active['location']}**")
-                st.write(f"Dalle: {active['start_time']}")
+                st.write(f"Dalle: {str(active['start_time'])[:16].replace('T', ' ')}")
                 st.subheader("🔴 Termina Turno")
                 loc_out = get_geolocation(component_key="out_geo")
                 if st.button("TIMBRA USCITA"):
                     if loc_out:
-                        supabase.table("logs").update({
-                            "end_time": datetime.now().isoformat(),
-                            "gps_lat_out": loc_out['coords']['latitude'],
-                            "gps_lon_out": loc_out['coords']['longitude'], "visto": 0
-                        }).eq("id", active['id']).execute()
-                        st.balloons(); time.sleep(1); st.rerun()
+                        v = punch_out(u_curr, active, loc_out)
+                        st.session_state.msg_feedback = f"Uscita registrata alle {v['end_time'][11:16]}."
+                        st.session_state.balloons = True
+                        st.rerun()
                     else: st.error("Attendi GPS.")
                 st.markdown("</div>", unsafe_allow_html=True)
                 
@@ -651,36 +2063,30 @@ else:
                     img_file = st.camera_input("Scatta una foto")
                     if st.button("INVIA SEGNALAZIONE"):
                         if d or img_file:
-                            url_foto = upload_photo(img_file)
-                            supabase.table("issues").insert({
+                            new = db_insert("issues", {
                                 "username": u_curr, "description": d, "location": active['location'],
                                 "timestamp": datetime.now().isoformat(), "status": "APERTA",
-                                "image_url": url_foto, "visto": 0
-                            }).execute()
-                            st.success("Inviata!"); time.sleep(1); st.rerun()
+                                "image_status": "PENDING" if img_file else None, "visto": 0
+                            })
+                            if img_file and new: queue_photo(new[0]['id'], img_file)
+                            st.session_state.msg_feedback = "Segnalazione inviata!"; st.rerun()
                         else: st.error("Scrivi qualcosa o fai una foto.")
             else:
                 st.markdown("<div class='stBlock'>", unsafe_allow_html=True)
                 st.subheader("🟩 Inizia Turno")
-                df_ass = get_df("assignments")
-                locs = []
-                if not df_ass.empty and 'username' in df_ass.columns:
-                    locs = df_ass[df_ass['username'] == u_curr]['location'].tolist()
+                locs = ref_data().locations(u_curr)
                 
                 if locs:
                     sl = st.selectbox("Cantiere", locs)
                     lin = get_geolocation(component_key="in_geo")
                     if st.button("TIMBRA INGRESSO"):
                         if lin:
-                            supabase.table("logs").insert({
-                                "username": u_curr, "location": sl,
-                                "start_time": datetime.now().isoformat(),
-                                "gps_lat": lin['coords']['latitude'],
-                                "gps_lon": lin['coords']['longitude'], "visto": 0
-                            }).execute()
+                            r = punch_in(u_curr, sl, lin)
+                            st.session_state.msg_feedback = f"Ingresso registrato alle {r['start_time'][11:16]}."
                             st.rerun()
                         else: st.error("Attendi GPS.")
                 else: st.warning("Non hai cantieri assegnati.")
                 st.markdown("</div>", unsafe_allow_html=True)
 
+trace_end(trace)
 # --- FINE PROGRAMMA ---
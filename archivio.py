@@ -0,0 +1,305 @@
+"""Archivio freddo di CHEMIFOL: righe chiuse in file Parquet mensili.
+
+Turni chiusi (logs), richieste materiale archiviate e segnalazioni risolte non
+cambiano più: la compattazione sposta i mesi chiusi dalle tabelle vive in un
+file Parquet per tabella e mese (zstd, ordinato per data), in una cartella
+locale e, se configurato, anche nel bucket di storage del backend. app.py li
+rilegge solo quando un filtro sul tempo tocca un mese archiviato: memory map,
+solo le colonne richieste e i filtri spinti sulle statistiche dei row group.
+
+    python archivio.py --keep 3               # archivia i mesi chiusi più vecchi di 3 mesi
+    python archivio.py --keep 3 --dry-run     # solo conteggi
+    python archivio.py --db chemifol.db --dir archivio
+
+Senza --db il backend e l'archivio si leggono da .streamlit/secrets.toml, come app.py:
+
+    [archivio]
+    dir = "archivio"          # cartella locale (con il bucket fa da cache)
+    bucket = "archivio"       # copia nel bucket di storage
+    durevole = true           # senza bucket: la cartella sopravvive ai redeploy (disco persistente)
+
+La compattazione cancella le righe vive: senza bucket né durevole = true (o
+--durevole) si rifiuta, perché su un host effimero come Streamlit Cloud la
+cartella locale sparisce al primo redeploy e con lei lo storico.
+
+Struttura: <dir>/<tabella>/<AAAA-MM>.parquet più indice.json con righe, id
+minimo e massimo e data di scrittura di ogni mese. Prima si scrive il file,
+poi si cancellano le righe vive: un'interruzione lascia al massimo righe
+doppie, che chi legge scarta per id.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+INT, FLOAT, STR = "int64", "float64", "string"
+
+# Per tabella: colonna del mese, condizione di riga chiusa, colonne archiviate
+TABLES = {
+    "logs": {
+        "time": "start_time", "closed": [("not_is", "end_time", "null")],
+        "cols": {"id": INT, "username": STR, "location": STR, "start_time": STR, "end_time": STR,
+                 "gps_lat": FLOAT, "gps_lon": FLOAT, "gps_lat_out": FLOAT, "gps_lon_out": FLOAT,
+                 "client_id": STR, "visto": INT, "updated_at": STR},
+    },
+    "material_requests": {
+        "time": "request_date", "closed": [("eq", "status", "ARCHIVED")],
+        "cols": {"id": INT, "username": STR, "location": STR, "item_list": STR, "request_date": STR,
+                 "status": STR, "fornito_il": STR, "visto": INT, "updated_at": STR},
+    },
+    "issues": {
+        "time": "timestamp", "closed": [("eq", "status", "RISOLTO")],
+        "cols": {"id": INT, "username": STR, "location": STR, "description": STR, "timestamp": STR, "status": STR,
+                 "image_url": STR, "thumb_url": STR, "image_status": STR, "image_error": STR,
+                 "visto": INT, "updated_at": STR},
+    },
+}
+INDEX = "indice.json"
+INDEX_TTL = 300       # secondi prima di rileggere l'indice (dal bucket, se c'è)
+ROW_GROUP = 10_000
+DELETE_BATCH = 500
+
+_CAST = {INT: int, FLOAT: float, STR: str}
+
+
+def _schema(table):
+    import pyarrow as pa
+    return pa.schema([(c, pa.type_for_alias(t)) for c, t in TABLES[table]["cols"].items()])
+
+
+# Righe del backend (dict) -> tabella Arrow con lo schema fisso della tabella
+def _to_arrow(table, rows):
+    import pyarrow as pa
+    cols = TABLES[table]["cols"]
+    data = {c: [None if r.get(c) is None else _CAST[t](r[c]) for r in rows] for c, t in cols.items()}
+    return pa.table(data, schema=_schema(table))
+
+
+# Filtri dell'app -> espressione Arrow; quelli non traducibili (ov, keyset) li applica chi legge
+def _expr(filters, cols):
+    import pyarrow.compute as pc
+    ops = {"eq": "__eq__", "neq": "__ne__", "gt": "__gt__", "gte": "__ge__", "lt": "__lt__", "lte": "__le__"}
+    expr = None
+    for op, col, val in filters or []:
+        if col not in cols: continue
+        f = pc.field(col)
+        val = val.item() if hasattr(val, "item") else val
+        if op in ops: x = getattr(f, ops[op])(val)
+        elif op == "in_": x = f.isin([v.item() if hasattr(v, "item") else v for v in val])
+        elif op == "is_": x = f.is_null()
+        elif op == "not_is": x = f.is_valid()
+        else: continue
+        expr = x if expr is None else expr & x
+    return expr
+
+
+def _month_bounds(month):
+    y, m = int(month[:4]), int(month[5:7])
+    nxt = f"{y + 1:04d}-01" if m == 12 else f"{y:04d}-{m + 1:02d}"
+    return f"{month}-01T00:00:00", f"{nxt}-01T00:00:00"
+
+
+class Archive:
+    def __init__(self, path="archivio", backend=None, bucket=None, durable=False):
+        self.path, self.backend, self.bucket = path, backend if bucket else None, bucket
+        self.durable = bool(bucket) or durable  # i file restano anche se il disco locale si perde
+        self._lock = threading.Lock()
+        self._index = {}  # tabella -> (letto alle, indice)
+
+    def _file(self, table, name):
+        return os.path.join(self.path, table, name)
+
+    def _download(self, table, name):
+        data = self.backend.download(self.bucket, f"{table}/{name}")
+        os.makedirs(os.path.join(self.path, table), exist_ok=True)
+        tmp = self._file(table, name + ".tmp")
+        with open(tmp, "wb") as f: f.write(data)
+        os.replace(tmp, self._file(table, name))
+
+    def _upload(self, table, name):
+        with open(self._file(table, name), "rb") as f:
+            self.backend.upload(self.bucket, f"{table}/{name}", f.read(), {"upsert": "true", "content-type": "application/octet-stream"})
+
+    def index(self, table):
+        hit = self._index.get(table)
+        if hit and time.monotonic() - hit[0] < INDEX_TTL: return hit[1]
+        if self.backend is not None:
+            try: self._download(table, INDEX)
+            except Exception: pass  # bucket vuoto o irraggiungibile: resta la copia locale
+        try:
+            with open(self._file(table, INDEX)) as f: idx = json.load(f)
+        except (OSError, ValueError):
+            idx = {}
+        self._index[table] = (time.monotonic(), idx)
+        return idx
+
+    def _save_index(self, table, idx):
+        tmp = self._file(table, INDEX + ".tmp")
+        with open(tmp, "w") as f: json.dump(idx, f, indent=1, sort_keys=True)
+        os.replace(tmp, self._file(table, INDEX))
+        self._index[table] = (time.monotonic(), idx)
+        if self.backend is not None: self._upload(table, INDEX)
+
+    # Mesi archiviati che toccano [lo, hi] (ISO, estremi inclusi: chi legge applica i filtri esatti)
+    # e, se ids è dato, il cui intervallo id_min..id_max ne contiene almeno uno
+    def months(self, table, lo=None, hi=None, ids=None):
+        out = []
+        for m, meta in sorted(self.index(table).items()):
+            start, end = _month_bounds(m)
+            if hi is not None and start > str(hi) or lo is not None and end < str(lo): continue
+            if ids is not None and not any(meta["id_min"] <= i <= meta["id_max"] for i in ids): continue
+            out.append(m)
+        return out
+
+    # Righe dei mesi dall'indice, senza aprire i file: solo se i filtri sono quelli
+    # che ogni riga archiviata soddisfa per costruzione (es. status = ARCHIVED), altrimenti None
+    def count(self, table, filters=(), months=None):
+        if any(tuple(f) not in TABLES[table]["closed"] for f in filters or []): return None
+        idx = self.index(table)
+        return sum(idx[m]["righe"] for m in (idx if months is None else months) if m in idx)
+
+    # Percorso locale del mese, scaricato dal bucket se manca o è più vecchio dell'ultima scrittura
+    def _local(self, table, month):
+        path, meta = self._file(table, f"{month}.parquet"), self.index(table).get(month)
+        if meta is None: return None
+        if self.backend is not None and (not os.path.exists(path) or os.path.getmtime(path) < meta.get("scritto", 0)):
+            self._download(table, f"{month}.parquet")
+        return path if os.path.exists(path) else None
+
+    def read(self, table, cols=None, filters=(), months=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        spec = TABLES[table]["cols"]
+        cols = [c for c in (cols or spec) if c in spec]
+        expr = _expr(filters, spec)
+        parts = []
+        for m in self.months(table) if months is None else months:
+            path = self._local(table, m)
+            if path is None: continue
+            try: parts.append(pq.read_table(path, columns=cols, filters=expr, memory_map=True))
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError, TypeError):
+                parts.append(pq.read_table(path, columns=cols, memory_map=True))
+        if not parts: return _schema(table).empty_table().select(cols).to_pandas()
+        return pa.concat_tables(parts).to_pandas()
+
+    def _write_month(self, table, month, t):
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        os.makedirs(os.path.join(self.path, table), exist_ok=True)
+        path, idx = self._file(table, f"{month}.parquet"), dict(self.index(table))
+        if t.num_rows == 0:
+            if os.path.exists(path): os.remove(path)
+            idx.pop(month, None)
+        else:
+            t = t.sort_by([(TABLES[table]["time"], "ascending"), ("id", "ascending")])
+            pq.write_table(t, path + ".tmp", compression="zstd", row_group_size=ROW_GROUP)
+            os.replace(path + ".tmp", path)
+            if self.backend is not None: self._upload(table, f"{month}.parquet")
+            lo, hi = pc.min_max(t["id"]).values()
+            idx[month] = {"righe": t.num_rows, "id_min": lo.as_py(), "id_max": hi.as_py(), "scritto": time.time()}
+        self._save_index(table, idx)
+
+    # Unisce le righe al mese (per id vince la nuova) e riscrive il file
+    def write(self, table, month, rows):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        with self._lock:
+            new, path = _to_arrow(table, rows), self._local(table, month)
+            if path:
+                old = pq.read_table(path).cast(new.schema)
+                new = pa.concat_tables([old.filter(pc.invert(pc.is_in(old["id"], new["id"]))), new])
+            self._write_month(table, month, new)
+        return new.num_rows
+
+    # Toglie gli id dai mesi il cui intervallo di id li può contenere; ritorna quante righe ha tolto
+    def delete(self, table, ids):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        ids = sorted({int(i) for i in ids})
+        if not ids: return 0
+        n = 0
+        with self._lock:
+            for month in self.months(table, ids=ids):
+                path = self._local(table, month)
+                if path is None: continue
+                t = pq.read_table(path)
+                keep = t.filter(pc.invert(pc.is_in(t["id"], pa.array(ids, pa.int64()))))
+                if keep.num_rows == t.num_rows: continue
+                n += t.num_rows - keep.num_rows
+                self._write_month(table, month, keep)
+        return n
+
+
+def cutoff(keep, now=None):
+    now = now or datetime.now()
+    y, m = now.year, now.month - keep
+    while m < 1: y, m = y - 1, m + 12
+    return f"{y:04d}-{m:02d}-01T00:00:00"
+
+
+# Sposta nell'archivio le righe chiuse dei mesi precedenti a cutoff(keep).
+# delete(tabella, id) cancella le righe vive (app.py passa la sua, che aggiorna cache e mirror).
+def compact(backend, archive, keep=3, now=None, dry_run=False, delete=None, page=1000):
+    if not dry_run and not archive.durable:
+        raise ValueError("Archivio solo su disco locale: configura un bucket o dichiara la cartella durevole")
+    limit, out = cutoff(keep, now), {}
+    delete = delete or (lambda table, ids: backend.delete(table, [("in_", "id", ids)]))
+    for table, spec in TABLES.items():
+        flt, rows, last = list(spec["closed"]) + [("lt", spec["time"], limit)], [], None
+        while True:
+            chunk, _ = backend.select(table, "*", flt + ([("gt", "id", last)] if last is not None else []), ["id"], limit=page)
+            rows += chunk
+            if len(chunk) < page: break
+            last = chunk[-1]["id"]
+        by_month = {}
+        for r in rows: by_month.setdefault(str(r[spec["time"]])[:7], []).append(r)
+        out[table] = {m: len(v) for m, v in sorted(by_month.items())}
+        if dry_run: continue
+        for month, rs in sorted(by_month.items()):
+            archive.write(table, month, rs)
+            ids = [int(r["id"]) for r in rs]
+            for i in range(0, len(ids), DELETE_BATCH): delete(table, ids[i:i + DELETE_BATCH])
+    return out
+
+
+def _from_secrets(path):
+    import tomllib
+    from backend import make_backend
+    with open(path, "rb") as f: sec = tomllib.load(f)
+    conf = dict(sec.get("backend", {}))
+    if conf.get("type", "supabase") == "supabase": conf = {"type": "supabase", "url": sec["supabase"]["url"], "key": sec["supabase"]["key"]}
+    return make_backend(conf), dict(sec.get("archivio", {}))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--keep", type=int, default=3, help="mesi recenti da lasciare nelle tabelle vive")
+    ap.add_argument("--db", help="database SQLite (altrimenti il backend dei secrets)")
+    ap.add_argument("--storage-dir", default="storage")
+    ap.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"))
+    ap.add_argument("--dir", help="cartella dell'archivio")
+    ap.add_argument("--bucket", help="bucket di storage per la copia dell'archivio")
+    ap.add_argument("--durevole", action="store_true", help="la cartella è su disco persistente (senza bucket)")
+    ap.add_argument("--dry-run", action="store_true")
+    a = ap.parse_args()
+    if a.db:
+        from backend import SQLiteBackend
+        b, conf = SQLiteBackend(a.db, a.storage_dir), {}
+    else:
+        b, conf = _from_secrets(a.secrets)
+    arch = Archive(a.dir or conf.get("dir", "archivio"), b, a.bucket or conf.get("bucket"), a.durevole or bool(conf.get("durevole")))
+    if not a.dry_run and not arch.durable:
+        ap.error("senza --bucket l'archivio resta solo nella cartella locale: aggiungi --durevole se è su disco persistente")
+    t0 = time.perf_counter()
+    res = compact(b, arch, a.keep, dry_run=a.dry_run)
+    for table, months in res.items():
+        print(f"{table:18} {sum(months.values()):7} righe" + (f"  ({min(months)} … {max(months)})" if months else ""))
+    print(f"{'Da archiviare' if a.dry_run else 'Archiviato'} fino a {cutoff(a.keep)[:7]} escluso in {time.perf_counter() - t0:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""Accesso ai dati di CHEMIFOL.
+
+Backend è l'interfaccia usata da app.py per tabelle e bucket foto; le
+implementazioni sono SupabaseBackend (progetto ospitato) e SQLiteBackend
+(file SQLite indicizzato + cartella locale per le foto, per lavorare offline,
+caricare volumi realistici e confrontare piani di esecuzione e tempi).
+
+Si sceglie da .streamlit/secrets.toml:
+
+    [backend]
+    type = "sqlite"                 # oppure "supabase" (predefinito)
+    path = "chemifol.db"
+    storage_dir = "storage"
+
+Filtri: lista di tuple (operatore, colonna, valore) con gli operatori di
+PostgREST: eq, neq, gt, gte, lt, lte, in_, is_ ("null"), not_is ("null"),
+ov (la colonna array ha almeno un elemento in val), più keyset_lt /
+keyset_gt che confrontano (colonna, id) con val = (valore, id).
+Le colonne array (text[] su Postgres) in SQLite sono testo JSON, convertito
+in lista in lettura: l'app vede sempre liste.
+
+OBSERVERS: funzioni chiamate dopo ogni operazione con un dict
+{op, table, filters, rows, bytes, ms, error}; servono a benchmark e tracing.
+Contare i byte vuol dire serializzare il risultato: un observer può avere un
+attributo wants_bytes (funzione senza argomenti); se tutti ritornano False la
+serializzazione si salta e bytes è None (upload e download hanno sempre i byte).
+"""
+import abc
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+OBSERVERS = []
+
+
+def _wants_bytes(cb):
+    try: return getattr(cb, "wants_bytes", lambda: True)()
+    except Exception: return True
+
+
+class Backend(abc.ABC):
+    # Ritorna (righe, conteggio); il conteggio è None se count=False
+    def select(self, table, cols="*", filters=(), order=(), desc=False, limit=None, count=False, head=False):
+        return self._call("select", table, filters, self._select, table, cols, filters, order, desc, limit, count, head)
+
+    def insert(self, table, rows):
+        return self._call("insert", table, (), self._insert, table, rows)
+
+    def update(self, table, values, filters):
+        return self._call("update", table, filters, self._update, table, values, filters)
+
+    def upsert(self, table, rows, on_conflict):
+        return self._call("upsert", table, (), self._upsert, table, rows, on_conflict)
+
+    def delete(self, table, filters):
+        return self._call("delete", table, filters, self._delete, table, filters)
+
+    def upload(self, bucket, path, data, options=None):
+        return self._call("upload", bucket, (), self._upload, bucket, path, data, options)
+
+    def download(self, bucket, path):
+        return self._call("download", bucket, (), self._download, bucket, path)
+
+    def public_url(self, bucket, path):
+        return self._public_url(bucket, path)
+
+    # Senza observer la chiamata passa dritta; i byte (json.dumps del risultato)
+    # si contano solo se almeno un observer li vuole in quel momento
+    def _call(self, op, table, filters, fn, *args):
+        if not OBSERVERS: return fn(*args)
+        t0, out, err = time.perf_counter(), None, None
+        try:
+            out = fn(*args)
+            return out
+        except Exception as e:
+            err = repr(e)
+            raise
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            cbs = list(OBSERVERS)
+            sized = any(_wants_bytes(cb) for cb in cbs)
+            if op == "upload": rows, size = 0, len(args[2])
+            elif op == "download": rows, size = 0, len(out or b"")
+            else:
+                data = out[0] if op == "select" and out else out
+                rows = len(data) if isinstance(data, list) else 0
+                size = (len(json.dumps(data, default=str)) if data else 0) if sized else None
+            ev = {"op": op, "table": table, "filters": list(filters or []), "rows": rows, "bytes": size, "ms": ms, "error": err}
+            for cb in cbs:
+                try: cb(ev)
+                except Exception: pass
+
+    # Da implementare in ogni backend: una sottoclasse incompleta non si istanzia
+    @abc.abstractmethod
+    def _select(self, table, cols, filters, order, desc, limit, count, head):
+        ...
+
+    @abc.abstractmethod
+    def _insert(self, table, rows):
+        ...
+
+    @abc.abstractmethod
+    def _update(self, table, values, filters):
+        ...
+
+    @abc.abstractmethod
+    def _upsert(self, table, rows, on_conflict):
+        ...
+
+    @abc.abstractmethod
+    def _delete(self, table, filters):
+        ...
+
+    @abc.abstractmethod
+    def _upload(self, bucket, path, data, options):
+        ...
+
+    @abc.abstractmethod
+    def _download(self, bucket, path):
+        ...
+
+    @abc.abstractmethod
+    def _public_url(self, bucket, path):
+        ...
+
+
+# ==============================================================================
+# SUPABASE
+# ==============================================================================
+class SupabaseBackend(Backend):
+    def __init__(self, url, key):
+        from supabase import create_client
+        self.client = create_client(url, key)
+
+    @staticmethod
+    def _filters(q, filters):
+        for op, col, val in filters or []:
+            if op == "not_is": q = q.not_.is_(col, val)
+            elif op in ("keyset_lt", "keyset_gt"):
+                o, (v, i) = op[-2:], val
+                q = q.or_(f'{col}.{o}."{v}",and({col}.eq."{v}",id.{o}.{i})')
+            else: q = getattr(q, op)(col, val)
+        return q
+
+    def _select(self, table, cols, filters, order, desc, limit, count, head):
+        q = self.client.table(table).select(cols, count="exact" if count else None, head=head or None)
+        q = self._filters(q, filters)
+        for c in order or []: q = q.order(c, desc=desc)
+        if limit: q = q.limit(limit)
+        res = q.execute()
+        return res.data or [], res.count
+
+    def _insert(self, table, rows):
+        return self.client.table(table).insert(rows).execute().data
+
+    def _update(self, table, values, filters):
+        return self._filters(self.client.table(table).update(values), filters).execute().data
+
+    def _upsert(self, table, rows, on_conflict):
+        return self.client.table(table).upsert(rows, on_conflict=on_conflict).execute().data
+
+    def _delete(self, table, filters):
+        return self._filters(self.client.table(table).delete(), filters).execute().data
+
+    def _upload(self, bucket, path, data, options):
+        self.client.storage.from_(bucket).upload(path, data, options or {})
+
+    def _download(self, bucket, path):
+        return self.client.storage.from_(bucket).download(path)
+
+    def _public_url(self, bucket, path):
+        return self.client.storage.from_(bucket).get_public_url(path)
+
+
+# ==============================================================================
+# SQLITE LOCALE
+# ==============================================================================
+_NOW = "(strftime('%Y-%m-%dT%H:%M:%f', 'now'))"
+
+# Stesso schema delle tabelle Supabase (migrazioni in supabase/migrations)
+SCHEMA = f"""
+create table if not exists users (
+    id integer primary key autoincrement,
+    username text unique not null, password text, role text default 'user',
+    nome_completo text, pwd_changed integer default 0
+);
+create table if not exists cantieri (
+    id integer primary key autoincrement,
+    nome_cantiere text not null, attivo integer default 1,
+    lat real, lon real, raggio_m integer default 200
+);
+create table if not exists assignments (
+    id integer primary key autoincrement,
+    username text not null, location text not null
+);
+create table if not exists logs (
+    id integer primary key autoincrement,
+    username text, location text, start_time text, end_time text,
+    gps_lat real, gps_lon real, gps_lat_out real, gps_lon_out real,
+    visto integer default 0, client_id text, updated_at text not null default {_NOW}
+);
+create table if not exists issues (
+    id integer primary key autoincrement,
+    username text, location text, description text, "timestamp" text, status text,
+    image_url text, thumb_url text, image_status text, image_error text,
+    visto integer default 0, updated_at text not null default {_NOW}
+);
+create table if not exists material_requests (
+    id integer primary key autoincrement,
+    username text, location text, item_list text, request_date text, status text, fornito_il text,
+    visto integer default 0, updated_at text not null default {_NOW}
+);
+create table if not exists bacheca (
+    id integer primary key autoincrement,
+    titolo text, messaggio text, destinatario text, destinatari text,
+    data_pubblicazione text, data_scadenza text
+);
+create table if not exists bacheca_archivio (
+    id integer primary key,
+    titolo text, messaggio text, destinatario text, destinatari text,
+    data_pubblicazione text, data_scadenza text
+);
+create table if not exists ore_giornaliere (
+    id integer primary key autoincrement,
+    username text not null, location text not null, giorno text not null,
+    ore real not null default 0, turni integer not null default 0,
+    unique (username, location, giorno)
+);
+
+create index if not exists logs_username_start_idx on logs (username, start_time desc);
+create index if not exists logs_location_start_idx on logs (location, start_time desc);
+create index if not exists logs_start_idx on logs (start_time desc);
+create index if not exists logs_open_shift_idx on logs (username) where end_time is null;
+create index if not exists logs_updated_at_idx on logs (updated_at);
+create index if not exists logs_unread_idx on logs (id) where visto = 0;
+create index if not exists assignments_username_idx on assignments (username);
+create index if not exists material_requests_status_date_id_idx on material_requests (status, request_date desc, id desc);
+create index if not exists material_requests_username_date_idx on material_requests (username, request_date desc);
+create index if not exists material_requests_updated_at_idx on material_requests (updated_at);
+create index if not exists material_requests_unread_idx on material_requests (id) where visto = 0;
+create index if not exists issues_status_ts_id_idx on issues (status, "timestamp" desc, id desc);
+create index if not exists issues_updated_at_idx on issues (updated_at);
+create index if not exists issues_unread_idx on issues (id) where visto = 0;
+create index if not exists bacheca_scadenza_idx on bacheca (data_scadenza);
+create index if not exists ore_giornaliere_giorno_idx on ore_giornaliere (giorno);
+""" + "".join(f"""
+create trigger if not exists {t}_set_updated_at after update on {t}
+    for each row when new.updated_at = old.updated_at
+    begin update {t} set updated_at = {_NOW} where id = new.id; end;
+""" for t in ("logs", "issues", "material_requests"))
+
+_IDENT = re.compile(r"^\w+$")
+_SQL_OPS = {"eq": "=", "neq": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+
+
+def _q(name):
+    if not _IDENT.match(name): raise ValueError(f"Nome non valido: {name!r}")
+    return f'"{name}"'
+
+
+# Colonne aggiunte dopo la prima versione dello schema: i database locali
+# già creati le ricevono all'apertura (come le migration su Supabase)
+ADDED_COLUMNS = [
+    ("cantieri", "lat", "real"), ("cantieri", "lon", "real"), ("cantieri", "raggio_m", "integer default 200"),
+    ("logs", "client_id", "text"),
+    ("material_requests", "fornito_il", "text"),
+    ("bacheca", "destinatari", "text",
+     """update bacheca set destinatari = (select json_group_array(trim(value)) from json_each('["' || replace(destinatario, ',', '","') || '"]'))
+        where destinatario is not null"""),
+]
+# Indici su colonne aggiunte: creati dopo ADDED_COLUMNS
+ADDED_INDEXES = [
+    "create unique index if not exists logs_client_id_key on logs (client_id)",
+]
+
+
+# Colonne array (text[] su Postgres), salvate come JSON
+ARRAY_COLUMNS = {"destinatari"}
+
+
+def _param(v):
+    if isinstance(v, (list, tuple)): return json.dumps(list(v))
+    return v.item() if hasattr(v, "item") else v
+
+
+class SQLiteBackend(Backend):
+    def __init__(self, path="chemifol.db", storage_dir="storage"):
+        self.path, self.storage_dir = path, storage_dir
+        self._local = threading.local()
+        with self._conn() as c:
+            c.executescript(SCHEMA)
+            for table, col, decl, *backfill in ADDED_COLUMNS:
+                if col not in {r[1] for r in c.execute(f"pragma table_info({table})")}:
+                    c.execute(f"alter table {table} add column {col} {decl}")
+                    for sql in backfill: c.execute(sql)
+            for ddl in ADDED_INDEXES: c.execute(ddl)
+
+    # Una connessione per thread (la cache e la coda foto lavorano in thread separati)
+    def _conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            c.row_factory = sqlite3.Row
+            c.execute("pragma journal_mode = wal")
+            c.execute("pragma synchronous = normal")
+            self._local.conn = c
+        return c
+
+    # I valori numpy/pandas (es. id letti da un DataFrame) diventano tipi Python
+    def _exec(self, sql, params=()):
+        rows = [dict(r) for r in self._conn().execute(sql, [_param(v) for v in params]).fetchall()]
+        for r in rows:
+            for k in ARRAY_COLUMNS.intersection(r):
+                if isinstance(r[k], str): r[k] = json.loads(r[k])
+        return rows
+
+    @staticmethod
+    def _where(filters):
+        parts, params = [], []
+        for op, col, val in filters or []:
+            c = _q(col)
+            if op == "is_": parts.append(f"{c} is null")
+            elif op == "not_is": parts.append(f"{c} is not null")
+            elif op == "in_":
+                val = list(val)
+                parts.append(f"{c} in ({','.join('?' * len(val))})" if val else "0")
+                params += val
+            elif op == "ov":
+                val = list(val)
+                parts.append(f"exists (select 1 from json_each({c}) where value in ({','.join('?' * len(val))}))" if val else "0")
+                params += val
+            elif op in ("keyset_lt", "keyset_gt"):
+                o, (v, i) = _SQL_OPS[op[-2:]], val
+                parts.append(f"({c} {o} ? or ({c} = ? and id {o} ?))")
+                params += [v, v, i]
+            else:
+                parts.append(f"{c} {_SQL_OPS[op]} ?")
+                params.append(val)
+        return (" where " + " and ".join(parts)) if parts else "", params
+
+    def _select(self, table, cols, filters, order, desc, limit, count, head):
+        where, params = self._where(filters)
+        n = self._exec(f"select count(*) as n from {_q(table)}{where}", params)[0]["n"] if count else None
+        if head: return [], n
+        sel = "*" if cols == "*" else ", ".join(_q(c.strip()) for c in cols.split(","))
+        sql = f"select {sel} from {_q(table)}{where}"
+        if order: sql += " order by " + ", ".join(f"{_q(c)} {'desc' if desc else 'asc'}" for c in order)
+        if limit: sql += f" limit {int(limit)}"
+        return self._exec(sql, params), n
+
+    def _insert(self, table, rows):
+        rows = rows if isinstance(rows, list) else [rows]
+        out = []
+        for r in rows:
+            cols = ", ".join(_q(k) for k in r)
+            out += self._exec(f"insert into {_q(table)} ({cols}) values ({','.join('?' * len(r))}) returning *", list(r.values()))
+        return out
+
+    # Caricamento massivo senza RETURNING, in una sola transazione (dati sintetici)
+    def bulk_insert(self, table, rows):
+        if not rows: return 0
+        keys = list(rows[0])
+        c = self._conn()
+        c.execute("begin")
+        try:
+            c.executemany(f"insert into {_q(table)} ({', '.join(_q(k) for k in keys)}) values ({','.join('?' * len(keys))})",
+                          [[_param(r.get(k)) for k in keys] for r in rows])
+            c.execute("commit")
+        except:
+            c.execute("rollback"); raise
+        return len(rows)
+
+    def _update(self, table, values, filters):
+        where, params = self._where(filters)
+        sets = ", ".join(f"{_q(k)} = ?" for k in values)
+        return self._exec(f"update {_q(table)} set {sets}{where} returning *", list(values.values()) + params)
+
+    def _upsert(self, table, rows, on_conflict):
+        rows = rows if isinstance(rows, list) else [rows]
+        keys = [k.strip() for k in on_conflict.split(",")]
+        out = []
+        for r in rows:
+            cols = ", ".join(_q(k) for k in r)
+            sets = ", ".join(f"{_q(k)} = excluded.{_q(k)}" for k in r if k not in keys) or f"{_q(keys[0])} = excluded.{_q(keys[0])}"
+            out += self._exec(
+                f"insert into {_q(table)} ({cols}) values ({','.join('?' * len(r))}) "
+                f"on conflict ({', '.join(_q(k) for k in keys)}) do update set {sets} returning *", list(r.values()))
+        return out
+
+    def _delete(self, table, filters):
+        where, params = self._where(filters)
+        return self._exec(f"delete from {_q(table)}{where} returning *", params)
+
+    def _file(self, bucket, path):
+        full = os.path.abspath(os.path.join(self.storage_dir, bucket, path))
+        if not full.startswith(os.path.abspath(self.storage_dir) + os.sep): raise ValueError(f"Percorso non valido: {path!r}")
+        return full
+
+    def _upload(self, bucket, path, data, options):
+        full = self._file(bucket, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        with open(full, "wb") as f: f.write(data)
+
+    def _download(self, bucket, path):
+        with open(self._file(bucket, path), "rb") as f: return f.read()
+
+    # st.image accetta un percorso locale
+    def _public_url(self, bucket, path):
+        return self._file(bucket, path)
+
+
+def make_backend(conf):
+    kind = conf.get("type", "supabase")
+    if kind == "supabase": return SupabaseBackend(conf["url"], conf["key"])
+    if kind == "sqlite": return SQLiteBackend(conf.get("path", "chemifol.db"), conf.get("storage_dir", "storage"))
+    raise ValueError(f"Backend sconosciuto: {kind}")
@@ -0,0 +1,284 @@
+"""Benchmark delle pagine di app.py su dati sintetici e backend SQLite locale.
+
+Ogni pagina admin e dipendente viene eseguita headless con AppTest, ciascuna in
+un processo nuovo (cache di processo vuote, risultato indipendente dall'ordine);
+dopo l'auto-login si misurano tempo (primo giro a cache fredde e mediana dei
+giri successivi), chiamate al backend, righe e byte trasferiti, picco di memoria
+(tracemalloc, dopo la compilazione dello script che AppTest rifà a ogni giro e
+al netto di un rerun a vuoto della pagina iniziale), e si controlla che la traccia del rerun (pannello Debug) riporti
+le stesse chiamate, righe e byte visti dal backend (exit 1 altrimenti).
+Avvio a freddo: in un processo nuovo (solo streamlit caricato, come un server
+appena partito) il primo disegno della schermata di accesso e del Timbratore
+(auto-login + menu), con un budget in ms e i moduli pesanti ammessi
+(STARTUP_MODULES): un modulo pesante in più fa fallire come un budget superato.
+
+    python bench.py --out bench_baseline.json                  # crea la baseline
+    python bench.py --compare bench_baseline.json              # confronta, exit 1 se peggiora
+    python bench.py --workers 20 --years 0.5 --repeat 2        # scala ridotta
+    python bench.py --budget-login 1500 --budget-timbratore 3000  # istanza piccola
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import backend
+import seed
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+ADMIN_PAGES = ["📢 Bacheca & News", "📦 Richiesta Materiale", "👥 Staff & Cantieri", "⚠️ Segnalazioni",
+               "🗺️ Mappe GPS", "📊 Report Ore", "🗓️ Calendario", "🔐 Sicurezza"]
+EMPLOYEE_PAGES = ["📢 Bacheca", "📦 Richiesta Materiale", "📍 Timbratore"]
+
+# Viste secondarie raggiunte con un radio della pagina: (pagina, indice radio, valore)
+SUB_VIEWS = [("📦 Richiesta Materiale", 0, "ARCHIVIO (Forniti)"), ("⚠️ Segnalazioni", 0, "RISOLTE")]
+
+
+# Avvio a freddo: budget (ms) del primo disegno e moduli pesanti ammessi per schermata
+# (più quelli che questi caricano da soli, es. pyarrow con pandas 3); gli altri fanno fallire
+STARTUP_BUDGET_MS = {"login": 1000, "timbratore": 2000}
+HEAVY_MODULES = ["pandas", "numpy", "PIL", "pydeck", "streamlit_js_eval", "xlsxwriter", "pyarrow"]
+STARTUP_MODULES = {"login": [], "timbratore": ["pandas", "numpy", "streamlit_js_eval"]}
+
+
+class Calls:
+    def __init__(self): self.events = []
+    def __call__(self, ev): self.events.append(dict(ev, t=time.perf_counter()))
+    def summary(self):
+        return {"calls": len(self.events), "rows": sum(e["rows"] for e in self.events),
+                "bytes": sum(e["bytes"] for e in self.events), "backend_ms": round(sum(e["ms"] for e in self.events), 1)}
+
+
+def _session(conf, user):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP, default_timeout=300)
+    at.secrets["backend"] = conf
+    at.query_params["u_persist"] = user
+    at.run()
+    return at
+
+
+def _measure(at, action):
+    calls = Calls()
+    backend.OBSERVERS.append(calls)
+    try:
+        t0 = time.perf_counter()
+        action(at)
+        ms = (time.perf_counter() - t0) * 1000
+    finally:
+        backend.OBSERVERS.remove(calls)
+    err = [e.message for e in at.exception]
+    return ms, calls.summary(), err[0] if err else None, _trace_check(at, calls)
+
+
+# La traccia dell'ultimo rerun deve contenere le chiamate al backend fatte durante quel rerun
+def _trace_check(at, calls):
+    try: tr = at.session_state["trace"]
+    except KeyError: return None
+    seen = [e for e in calls.events if e["t"] >= tr.t0]
+    d = tr.to_dict()
+    got = {"calls": d["db_calls"], "rows": d["db_rows"], "bytes": d["db_bytes"]}
+    want = {"calls": len(seen), "rows": sum(e["rows"] for e in seen), "bytes": sum(e["bytes"] for e in seen)}
+    return None if got == want else f"traccia {got}, backend {want}"
+
+
+def _peak_kb(at, action):
+    tracemalloc.start()
+    try:
+        action(at)
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+# AppTest ricompila app.py a ogni rerun (~12 MB di AST, più di qualsiasi pagina):
+# il picco riparte da quando il bytecode è pronto
+def _skip_compile_peak():
+    from streamlit.runtime.scriptrunner import script_cache
+    get = script_cache.ScriptCache.get_bytecode
+
+    def get_bytecode(self, path):
+        code = get(self, path)
+        if tracemalloc.is_tracing(): tracemalloc.reset_peak()
+        return code
+    script_cache.ScriptCache.get_bytecode = get_bytecode
+
+
+# Picco della pagina oltre quello di un rerun senza modifiche sulla pagina iniziale
+# (sidebar, stile, login: il disegno di base comune a tutte)
+def _page_peak_kb(at, action):
+    radio = at.sidebar.radio[0]
+    radio.set_value(radio.options[0]).run()
+    base = _peak_kb(at, lambda at: at.run())
+    return max(0, _peak_kb(at, action) - base)
+
+
+def _scenarios():
+    for p in ADMIN_PAGES:
+        yield "admin", p, lambda at, p=p: at.sidebar.radio[0].set_value(p).run()
+    for p, i, v in SUB_VIEWS:
+        def go(at, p=p, i=i, v=v):
+            at.sidebar.radio[0].set_value(p).run()
+            at.radio[i].set_value(v).run()
+        yield "admin", f"{p} / {v}", go
+    for p in EMPLOYEE_PAGES:
+        yield "employee", p, lambda at, p=p: at.sidebar.radio[0].set_value(p).run()
+
+
+# Una pagina in un processo nuovo: cache di processo, mirror e cache_resource partono
+# vuoti, così il giro a freddo non dipende dalle pagine misurate prima
+def _page(conf, user, index, repeat, out):
+    role, name, action = list(_scenarios())[index]
+    _skip_compile_peak()
+    try:
+        at = _session(conf, user)
+        cold_ms, cold, err, trace_err = _measure(at, action)
+        warm = [_measure(at, action) for _ in range(max(0, repeat - 1))]
+        peak = _page_peak_kb(at, action)
+    except Exception as e:
+        out.put({"cold_ms": None, "warm_ms": None, "cold": None, "warm": None, "peak_kb": None,
+                 "error": f"{type(e).__name__}: {e}", "trace_error": None})
+        return
+    warm_ms = statistics.median(w[0] for w in warm) if warm else cold_ms
+    out.put({"cold_ms": round(cold_ms, 1), "warm_ms": round(warm_ms, 1),
+             "cold": cold, "warm": warm[-1][1] if warm else cold, "peak_kb": peak,
+             "error": err or next((w[2] for w in warm if w[2]), None),
+             "trace_error": trace_err or next((w[3] for w in warm if w[3]), None)})
+
+
+def run(conf, repeat, employee):
+    users = {"admin": seed.ADMIN, "employee": employee}
+    results = {}
+    for i, (role, name, _) in enumerate(_scenarios()):
+        results[f"{role}: {name}"] = r = _spawn(_page, conf, users[role], i, repeat)
+        if r["cold"] is None:
+            print(f"{role:9} {name:45} ERRORE: {r['error']}", flush=True)
+            continue
+        print(f"{role:9} {name:45} cold {r['cold_ms']:8.1f} ms  warm {r['warm_ms']:8.1f} ms  "
+              f"calls {r['cold']['calls']:3}/{r['warm']['calls']:3}  bytes {r['cold']['bytes']:>10}  peak {r['peak_kb']:>8} KB"
+              + (f"  ERRORE: {r['error']}" if r["error"] else "") + (f"  TRACCIA: {r['trace_error']}" if r["trace_error"] else ""), flush=True)
+    return results
+
+
+def _cold(conf, screen, employee, out):
+    from streamlit.testing.v1 import AppTest
+    loaded = set(sys.modules)
+    at = AppTest.from_file(APP, default_timeout=300)
+    at.secrets["backend"] = conf
+    if screen == "timbratore": at.query_params["u_persist"] = employee
+    t0 = time.perf_counter()
+    at.run()
+    if screen == "timbratore": at.sidebar.radio[0].set_value("📍 Timbratore").run()
+    ms = (time.perf_counter() - t0) * 1000
+    err = [e.message for e in at.exception]
+    out.put({"ms": round(ms, 1), "modules": [m for m in HEAVY_MODULES if m in sys.modules and m not in loaded], "error": err[0] if err else None})
+
+
+# Moduli pesanti che arrivano importando mods in un processo nuovo
+def _imports(mods, out):
+    import importlib
+    loaded = set(sys.modules)
+    for m in mods: importlib.import_module(m)
+    out.put([m for m in HEAVY_MODULES if m in sys.modules and m not in loaded])
+
+
+def _spawn(target, *args):
+    ctx = mp.get_context("spawn")
+    out = ctx.Queue()
+    p = ctx.Process(target=target, args=args + (out,))
+    p.start(); r = out.get(); p.join()
+    return r
+
+
+def startup(conf, employee):
+    res = {}
+    for screen in STARTUP_BUDGET_MS:
+        res[screen] = r = _spawn(_cold, conf, screen, employee)
+        r["allowed"] = sorted(set(STARTUP_MODULES[screen]) | set(_spawn(_imports, STARTUP_MODULES[screen])))
+        print(f"avvio     {screen:45} {r['ms']:8.1f} ms  budget {STARTUP_BUDGET_MS[screen]} ms  moduli {', '.join(r['modules']) or '-'}"
+              + (f"  ERRORE: {r['error']}" if r["error"] else ""), flush=True)
+    return res
+
+
+def over_budget(startup_res):
+    bad = [f"avvio {s}: {r['ms']} ms oltre il budget di {STARTUP_BUDGET_MS[s]} ms" for s, r in startup_res.items() if r["ms"] > STARTUP_BUDGET_MS[s]]
+    for s, r in startup_res.items():
+        extra = [m for m in r["modules"] if m not in r.get("allowed", STARTUP_MODULES[s])]
+        if extra: bad.append(f"avvio {s}: caricati {', '.join(extra)}")
+    return bad
+
+
+# Regressione: tempo a caldo, byte o picco di memoria oltre la tolleranza, o una pagina che prima funzionava e ora no
+def compare(base, new, tolerance):
+    bad = []
+    for k, b in base.get("pages", {}).items():
+        n = new["pages"].get(k)
+        if n is None: continue
+        if n["error"] and not b["error"]: bad.append(f"{k}: errore {n['error']}")
+        if n["cold"] is None or b["cold"] is None: continue
+        if n["warm_ms"] > b["warm_ms"] * (1 + tolerance) and n["warm_ms"] - b["warm_ms"] > 20:
+            bad.append(f"{k}: warm {b['warm_ms']} -> {n['warm_ms']} ms")
+        if n["cold"]["bytes"] > b["cold"]["bytes"] * (1 + tolerance) and n["cold"]["bytes"] - b["cold"]["bytes"] > 10_000:
+            bad.append(f"{k}: bytes {b['cold']['bytes']} -> {n['cold']['bytes']}")
+        if (b.get("peak_kb") is not None and n["peak_kb"] > b["peak_kb"] * (1 + tolerance)
+                and n["peak_kb"] - b["peak_kb"] > 512):
+            bad.append(f"{k}: picco {b['peak_kb']} -> {n['peak_kb']} KB")
+    for k, b in base.get("startup", {}).items():
+        n = new.get("startup", {}).get(k)
+        if n and n["ms"] > b["ms"] * (1 + tolerance) and n["ms"] - b["ms"] > 100:
+            bad.append(f"avvio {k}: {b['ms']} -> {n['ms']} ms")
+    return bad
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", help="database SQLite già popolato (altrimenti ne genera uno temporaneo)")
+    ap.add_argument("--workers", type=int, default=80)
+    ap.add_argument("--cantieri", type=int, default=30)
+    ap.add_argument("--years", type=float, default=2)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--out", help="file JSON dei risultati (baseline)")
+    ap.add_argument("--compare", help="baseline JSON con cui confrontare")
+    ap.add_argument("--tolerance", type=float, default=0.25)
+    ap.add_argument("--budget-login", type=float, default=STARTUP_BUDGET_MS["login"], help="ms per la schermata di accesso a freddo")
+    ap.add_argument("--budget-timbratore", type=float, default=STARTUP_BUDGET_MS["timbratore"], help="ms per il Timbratore a freddo")
+    a = ap.parse_args()
+    STARTUP_BUDGET_MS.update(login=a.budget_login, timbratore=a.budget_timbratore)
+
+    tmp = tempfile.mkdtemp(prefix="chemifol_bench_")
+    path = a.db or os.path.join(tmp, "bench.db")
+    storage = os.path.join(tmp, "storage")
+    dataset = None
+    if not a.db:
+        t0 = time.perf_counter()
+        dataset = seed.generate(path, a.workers, a.cantieri, a.years, storage_dir=storage)
+        print(f"Dati sintetici: {dataset} in {time.perf_counter() - t0:.1f} s", flush=True)
+    conf = {"type": "sqlite", "path": path, "storage_dir": storage}
+    os.environ["CHEMIFOL_PUNCH_DB"] = os.path.join(tmp, "punch_queue.db")
+
+    boot = startup(conf, employee="op001")
+    pages = run(conf, a.repeat, employee="op001")
+    out = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0], "machine": platform.machine(),
+           "scale": {"workers": a.workers, "cantieri": a.cantieri, "years": a.years, "rows": dataset},
+           "startup": boot, "startup_budget_ms": dict(STARTUP_BUDGET_MS), "pages": pages}
+    if a.out:
+        with open(a.out, "w") as f: json.dump(out, f, indent=2, ensure_ascii=False)
+        print(f"Risultati in {a.out}")
+    bad = over_budget(boot) + [f"{k}: {p['trace_error']}" for k, p in pages.items() if p["trace_error"]]
+    for b in bad: print("BUDGET", b)
+    if a.compare:
+        with open(a.compare) as f: reg = compare(json.load(f), out, a.tolerance)
+        for b in reg: print("REGRESSIONE", b)
+        bad += reg
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Load test del Timbratore: N dipendenti che timbrano insieme a inizio turno.
+
+Ogni sessione virtuale (AppTest headless, un processo ciascuna: AppTest non
+regge più sessioni nello stesso processo) fa auto-login con
+u_persist, apre il Timbratore (ricerca turno aperto), TIMBRA INGRESSO e TIMBRA
+USCITA su backend SQLite locale con dati sintetici. Il click mette la
+timbratura nella coda del processo (passi ingresso/uscita); i passi
+ingresso_db/uscita_db misurano dal click fino alla scrittura nel database
+(coda svuotata). Ogni processo ha il suo file di coda: con un file condiviso i
+thread di invio dei vari processi scriverebbero più volte la stessa
+timbratura. Per ogni livello di concorrenza si riportano throughput e
+p50/p95/p99 per passo e, dalle chiamate al backend, quale (operazione,
+tabella) satura per prima.
+
+Ogni processo ha le sue cache e il suo mirror: il risultato è pessimistico
+rispetto al server reale, dove le sessioni condividono un solo processo.
+
+    python loadtest.py --users 10,25,50
+    python loadtest.py --users 50 --db bench.db --out loadtest.json
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import multiprocessing as mp
+import sqlite3
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import backend
+import seed
+from bench import APP
+
+STEPS = ["login", "timbratore", "ingresso", "ingresso_db", "uscita", "uscita_db"]
+DRAIN_TIMEOUT = 120  # secondi per vedere la timbratura arrivare al database
+
+# Posizione fissa al posto del browser: il componente JS non gira headless
+GPS = {"coords": {"latitude": 45.464, "longitude": 9.190}, "timestamp": 0}
+
+
+def _stub_gps():
+    import streamlit_js_eval
+    streamlit_js_eval.get_geolocation = lambda component_key=None: GPS
+
+
+def _button(at, label):
+    return next((b for b in at.button if b.label == label), None)
+
+
+def _pct(xs, p):
+    if not xs: return None
+    xs = sorted(xs)
+    return round(xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))], 1)
+
+
+def by_call(events):
+    g = defaultdict(list)
+    for op, table, ms in events: g[f"{op} {table}"].append(ms)
+    return {k: {"calls": len(v), "total_ms": round(sum(v), 1), "mean_ms": round(statistics.mean(v), 2),
+                "p95_ms": _pct(v, 95)} for k, v in sorted(g.items(), key=lambda kv: -sum(kv[1]))}
+
+
+# Aspetta che la coda del processo abbia inviato tutto al database
+def _drain(path):
+    t0 = time.perf_counter()
+    c = sqlite3.connect(path, timeout=30)
+    try:
+        while True:
+            pending, failed = c.execute("select count(*) filter (where status = 'PENDING'), count(*) filter (where status = 'ERRORE') from punches").fetchone()
+            if failed: raise RuntimeError("timbratura in ERRORE")
+            if not pending: return
+            if time.perf_counter() - t0 > DRAIN_TIMEOUT: raise RuntimeError("coda non svuotata")
+            time.sleep(0.01)
+    finally:
+        c.close()
+
+
+def session(conf, user, queue_dir, barrier, out):
+    from streamlit.testing.v1 import AppTest
+    _stub_gps()
+    queue = os.path.join(queue_dir, f"punch_{user}.db")
+    os.environ["CHEMIFOL_PUNCH_DB"] = queue
+    times, err, events = {}, None, []
+    backend.OBSERVERS.append(lambda ev: events.append((ev["op"], ev["table"], ev["ms"])))
+    try:
+        barrier.wait()
+        t = time.perf_counter()
+        at = AppTest.from_file(APP, default_timeout=300)
+        at.secrets["backend"] = conf
+        at.query_params["u_persist"] = user
+        at.run()
+        times["login"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        at.sidebar.radio[0].set_value("📍 Timbratore").run()
+        times["timbratore"] = time.perf_counter() - t
+
+        for step, label in (("ingresso", "TIMBRA INGRESSO"), ("uscita", "TIMBRA USCITA")):
+            b = _button(at, label)
+            if b is None: raise RuntimeError(f"{label} non disponibile")
+            t = time.perf_counter()
+            b.click().run()
+            times[step] = time.perf_counter() - t
+            _drain(queue)
+            times[f"{step}_db"] = time.perf_counter() - t
+        if at.exception: err = at.exception[0].message
+    except Exception as e:
+        err = f"{type(e).__name__}: {e}"
+    out.put({"user": user, "ms": {k: v * 1000 for k, v in times.items()}, "error": err, "events": events, "end": time.time()})
+
+
+def run_level(conf, users, queue_dir):
+    ctx = mp.get_context("spawn")
+    barrier, out = ctx.Barrier(len(users) + 1), ctx.Queue()
+    procs = [ctx.Process(target=session, args=(conf, u, queue_dir, barrier, out), daemon=True) for u in users]
+    for p in procs: p.start()
+    barrier.wait()  # tutti pronti (import fatti): si parte insieme
+    t0 = time.time()
+    results = [out.get() for _ in procs]
+    for p in procs: p.join()
+    wall = max(r["end"] for r in results) - t0
+    ok = [r for r in results if not r["error"]]
+    steps = {}
+    for s in STEPS:
+        xs = [r["ms"][s] for r in results if s in r["ms"]]
+        steps[s] = {"n": len(xs), "p50_ms": _pct(xs, 50), "p95_ms": _pct(xs, 95), "p99_ms": _pct(xs, 99)}
+    return {"sessions": len(users), "ok": len(ok), "wall_s": round(wall, 2),
+            # wall arriva fino alla coda svuotata: timbrature scritte nel database al secondo
+            "punches_per_s": round(2 * len(ok) / wall, 2) if wall else None,
+            "steps": steps, "calls": by_call([e for r in results for e in r["events"]]), "errors": sorted({r["error"] for r in results if r["error"]})}
+
+
+# La chiamata che satura: più tempo totale all'ultimo livello, con la crescita del tempo medio rispetto al primo
+def saturating(levels):
+    first, last = levels[0]["calls"], levels[-1]["calls"]
+    if not last: return None
+    name, c = next(iter(last.items()))
+    base = first.get(name, {}).get("mean_ms")
+    return {"call": name, "total_ms": c["total_ms"], "share": round(c["total_ms"] / sum(x["total_ms"] for x in last.values()), 2),
+            "mean_ms": c["mean_ms"], "growth": round(c["mean_ms"] / base, 1) if base else None}
+
+
+# Inizio turno: nessuno ha turni aperti
+def close_open_shifts(conf):
+    b = backend.make_backend(conf)
+    b.update("logs", {"end_time": datetime.now().isoformat()}, [("is_", "end_time", "null")])
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", default="10,25,50", help="livelli di concorrenza separati da virgola")
+    ap.add_argument("--db", help="database SQLite già popolato (altrimenti ne genera uno temporaneo)")
+    ap.add_argument("--workers", type=int, default=80)
+    ap.add_argument("--cantieri", type=int, default=30)
+    ap.add_argument("--years", type=float, default=1)
+    ap.add_argument("--out", help="file JSON dei risultati")
+    a = ap.parse_args()
+    levels_n = [int(x) for x in a.users.split(",")]
+
+    tmp = tempfile.mkdtemp(prefix="chemifol_load_")
+    path = a.db or os.path.join(tmp, "load.db")
+    storage = os.path.join(tmp, "storage")
+    if not a.db:
+        print("Dati sintetici:", seed.generate(path, max(a.workers, max(levels_n)), a.cantieri, a.years, storage_dir=storage), flush=True)
+    conf = {"type": "sqlite", "path": path, "storage_dir": storage}
+    staff = [r["username"] for r in backend.make_backend(conf).select("users", "username", [("eq", "role", "user")], order=("username",))[0]]
+    if len(staff) < max(levels_n): ap.error(f"solo {len(staff)} dipendenti nel database")
+
+    levels = []
+    for n in levels_n:
+        close_open_shifts(conf)
+        queue_dir = tempfile.mkdtemp(prefix=f"coda_{n}_", dir=tmp)
+        lv = run_level(conf, staff[:n], queue_dir)
+        levels.append(lv)
+        print(f"\n== {n} sessioni: {lv['ok']} ok in {lv['wall_s']} s, {lv['punches_per_s']} timbrature/s")
+        for s, v in lv["steps"].items():
+            print(f"   {s:11} p50 {v['p50_ms']!s:>8} ms  p95 {v['p95_ms']!s:>8} ms  p99 {v['p99_ms']!s:>8} ms")
+        for k, c in list(lv["calls"].items())[:5]:
+            print(f"   {k:32} {c['calls']:5} chiamate  tot {c['total_ms']:9} ms  media {c['mean_ms']:7} ms  p95 {c['p95_ms']} ms")
+        for e in lv["errors"]: print("   ERRORE", e)
+
+    sat = saturating(levels)
+    if sat: print(f"\nChiamata che satura: {sat['call']} ({int(sat['share'] * 100)}% del tempo backend, media {sat['mean_ms']} ms"
+                  + (f", x{sat['growth']} rispetto a {levels_n[0]} sessioni)" if sat["growth"] else ")"))
+    if a.out:
+        with open(a.out, "w") as f: json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "levels": levels, "saturating": sat}, f, indent=2, ensure_ascii=False)
+        print(f"Risultati in {a.out}")
+
+
+if __name__ == "__main__":
+    main()
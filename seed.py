@@ -0,0 +1,115 @@
+"""Dati sintetici realistici per CHEMIFOL su backend SQLite locale.
+
+Genera utenti, cantieri, assegnazioni, turni con GPS, segnalazioni, richieste
+materiale e bacheca su N anni fino a oggi, poi il riepilogo ore giornaliero.
+
+    python seed.py --db bench.db --workers 80 --cantieri 30 --years 2
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from backend import SQLiteBackend
+
+CITTA = [("Milano", 45.464, 9.190), ("Bergamo", 45.698, 9.677), ("Brescia", 45.541, 10.211),
+         ("Monza", 45.584, 9.274), ("Como", 45.808, 9.085), ("Varese", 45.820, 8.825),
+         ("Lodi", 45.314, 9.503), ("Pavia", 45.185, 9.158), ("Cremona", 45.133, 10.022)]
+
+ADMIN = "mimmo"
+
+
+def _iso(t):
+    return t.isoformat()
+
+
+# updated_at come lo scrive il trigger (_NOW in backend.py): UTC, millisecondi
+def _stamp(t):
+    return t.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+def generate(path, workers=80, cantieri=30, years=2, seed=1, storage_dir="storage"):
+    rnd = random.Random(seed)
+    if os.path.exists(path): os.remove(path)
+    b = SQLiteBackend(path, storage_dir)
+    now = datetime.now().replace(microsecond=0)
+    start = (now - timedelta(days=int(365 * years))).replace(hour=0, minute=0, second=0)
+
+    users = [{"username": ADMIN, "password": "admin", "role": "admin", "nome_completo": "Mimmo Folda", "pwd_changed": 1}]
+    staff = [f"op{i:03d}" for i in range(1, workers + 1)]
+    users += [{"username": u, "password": "1234", "role": "user", "nome_completo": f"Operaio {u[2:]}", "pwd_changed": 1} for u in staff]
+    b.bulk_insert("users", users)
+
+    sites = {}
+    for i in range(1, cantieri + 1):
+        city, lat, lon = rnd.choice(CITTA)
+        sites[f"Cantiere {i:02d} - {city}"] = (lat + rnd.uniform(-0.08, 0.08), lon + rnd.uniform(-0.08, 0.08))
+    b.bulk_insert("cantieri", [{"nome_cantiere": n, "attivo": 1, "lat": lat, "lon": lon, "raggio_m": rnd.choice([150, 200, 300])}
+                               for n, (lat, lon) in sites.items()])
+
+    assigned = {u: rnd.sample(list(sites), k=min(len(sites), rnd.randint(1, 3))) for u in staff}
+    b.bulk_insert("assignments", [{"username": u, "location": l} for u, ls in assigned.items() for l in ls])
+
+    logs, issues, reqs = [], [], []
+    day = start
+    while day.date() <= now.date():
+        for u in staff:
+            if day.weekday() >= 5 and rnd.random() > 0.1: continue
+            if rnd.random() > 0.9: continue
+            loc = rnd.choice(assigned[u])
+            lat, lon = sites[loc]
+            # Qualche timbratura lontana dal cantiere (a casa, in furgone...)
+            if rnd.random() < 0.02: lat, lon = lat + rnd.uniform(-0.03, 0.03), lon + rnd.uniform(-0.03, 0.03)
+            t_in = day + timedelta(hours=7, minutes=rnd.randint(-30, 30), seconds=rnd.randint(0, 59))
+            if t_in > now: continue
+            t_out = t_in + timedelta(hours=8, minutes=rnd.randint(-60, 60))
+            closed = t_out <= now
+            logs.append({
+                "username": u, "location": loc, "start_time": _iso(t_in), "end_time": _iso(t_out) if closed else None,
+                "gps_lat": lat + rnd.gauss(0, 0.0004), "gps_lon": lon + rnd.gauss(0, 0.0004),
+                "gps_lat_out": lat + rnd.gauss(0, 0.0004) if closed else None,
+                "gps_lon_out": lon + rnd.gauss(0, 0.0004) if closed else None,
+                "visto": 0 if (now - t_in).days < 2 else 1, "updated_at": _stamp(t_out if closed else t_in),
+            })
+            recent = (now - day).days < 14
+            if rnd.random() < 0.02:
+                issues.append({"username": u, "location": loc, "description": "Problema in cantiere (sintetico)",
+                               "timestamp": _iso(t_in + timedelta(hours=2)), "status": "APERTA" if recent else "RISOLTO",
+                               "visto": 0 if recent else 1, "updated_at": _stamp(t_in + timedelta(hours=2))})
+            if rnd.random() < 0.03:
+                reqs.append({"username": u, "location": loc, "item_list": f"{rnd.randint(1, 20)}x materiale (sintetico)",
+                             "request_date": _iso(t_in + timedelta(hours=1)), "status": "PENDING" if recent else "ARCHIVED",
+                             "visto": 0 if recent else 1, "updated_at": _stamp(t_in + timedelta(hours=1))})
+        day += timedelta(days=1)
+    b.bulk_insert("logs", logs)
+    b.bulk_insert("issues", issues)
+    b.bulk_insert("material_requests", reqs)
+
+    news, t = [], start
+    while t < now:
+        dest = ["TUTTI"] if rnd.random() < 0.6 else rnd.sample(staff, k=min(len(staff), 3))
+        news.append({"titolo": "Avviso (sintetico)", "messaggio": "Testo dell'avviso.", "destinatario": ",".join(dest), "destinatari": dest,
+                     "data_pubblicazione": _iso(t), "data_scadenza": _iso(t + timedelta(days=rnd.randint(7, 30)))})
+        t += timedelta(days=rnd.randint(2, 5))
+    b.bulk_insert("bacheca", news)
+
+    # Riepilogo ore come lo calcola rollup_backfill in app.py
+    c = b._conn()
+    c.execute("""insert into ore_giornaliere (username, location, giorno, ore, turni)
+                 select username, location, substr(start_time, 1, 10), round(sum(round((julianday(end_time) - julianday(start_time)) * 24, 2)), 2), count(*)
+                 from logs where end_time is not null group by username, location, substr(start_time, 1, 10)""")
+    c.execute("analyze")
+    return {"users": len(users), "cantieri": len(sites), "logs": len(logs), "issues": len(issues),
+            "material_requests": len(reqs), "bacheca": len(news)}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--db", default="chemifol.db")
+    ap.add_argument("--storage-dir", default="storage")
+    ap.add_argument("--workers", type=int, default=80)
+    ap.add_argument("--cantieri", type=int, default=30)
+    ap.add_argument("--years", type=float, default=2)
+    ap.add_argument("--seed", type=int, default=1)
+    a = ap.parse_args()
+    print(generate(a.db, a.workers, a.cantieri, a.years, a.seed, a.storage_dir))
@@ -0,0 +1,14 @@
+-- Indici per le query filtrate di get_df (filtri e ordinamenti lato server)
+create index if not exists logs_username_start_idx on logs (username, start_time desc);
+create index if not exists logs_location_start_idx on logs (location, start_time desc);
+create index if not exists logs_start_idx on logs (start_time desc);
+create index if not exists logs_open_shift_idx on logs (username) where end_time is null;
+
+create index if not exists assignments_username_idx on assignments (username);
+
+create index if not exists material_requests_status_date_idx on material_requests (status, request_date desc);
+create index if not exists material_requests_username_date_idx on material_requests (username, request_date desc);
+
+create index if not exists issues_status_ts_idx on issues (status, "timestamp" desc);
+
+create index if not exists bacheca_scadenza_idx on bacheca (data_scadenza);
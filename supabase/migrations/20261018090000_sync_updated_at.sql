@@ -0,0 +1,26 @@
+-- Watermark per la sincronizzazione incrementale (TableMirror in app.py):
+-- updated_at viene impostato dal server a ogni insert e update.
+create or replace function set_updated_at() returns trigger
+language plpgsql as $$
+begin
+    new.updated_at = now();
+    return new;
+end $$;
+
+alter table logs add column if not exists updated_at timestamptz not null default now();
+alter table issues add column if not exists updated_at timestamptz not null default now();
+alter table material_requests add column if not exists updated_at timestamptz not null default now();
+
+drop trigger if exists logs_set_updated_at on logs;
+create trigger logs_set_updated_at before update on logs
+    for each row execute function set_updated_at();
+drop trigger if exists issues_set_updated_at on issues;
+create trigger issues_set_updated_at before update on issues
+    for each row execute function set_updated_at();
+drop trigger if exists material_requests_set_updated_at on material_requests;
+create trigger material_requests_set_updated_at before update on material_requests
+    for each row execute function set_updated_at();
+
+create index if not exists logs_updated_at_idx on logs (updated_at);
+create index if not exists issues_updated_at_idx on issues (updated_at);
+create index if not exists material_requests_updated_at_idx on material_requests (updated_at);
@@ -0,0 +1,6 @@
+-- Paginazione keyset degli archivi: ordinamento (data, id) coperto dall'indice
+create index if not exists material_requests_status_date_id_idx on material_requests (status, request_date desc, id desc);
+create index if not exists issues_status_ts_id_idx on issues (status, "timestamp" desc, id desc);
+
+drop index if exists material_requests_status_date_idx;
+drop index if exists issues_status_ts_idx;
@@ -0,0 +1,23 @@
+-- Riepilogo ore per dipendente, postazione e giorno (ROLLUP_TABLE in app.py).
+-- L'app lo aggiorna alla chiusura dei turni e alla cancellazione dei log.
+create table if not exists ore_giornaliere (
+    id bigserial primary key,
+    username text not null,
+    location text not null,
+    giorno date not null,
+    ore numeric(8, 2) not null default 0,
+    turni integer not null default 0,
+    unique (username, location, giorno)
+);
+create index if not exists ore_giornaliere_giorno_idx on ore_giornaliere (giorno);
+
+-- Popolamento iniziale dai turni già chiusi (stesso arrotondamento del report)
+insert into ore_giornaliere (username, location, giorno, ore, turni)
+select username, location, start_time::date,
+       sum(round((extract(epoch from (end_time::timestamp - start_time::timestamp)) / 3600)::numeric, 2)),
+       count(*)
+from logs
+where end_time is not null
+group by username, location, start_time::date
+on conflict (username, location, giorno) do update
+    set ore = excluded.ore, turni = excluded.turni;
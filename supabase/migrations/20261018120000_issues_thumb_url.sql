@@ -0,0 +1,2 @@
+-- Miniatura della foto segnalazione (thumb/ nel bucket foto_cantieri)
+alter table issues add column if not exists thumb_url text;
@@ -0,0 +1,3 @@
+-- Stato del caricamento foto in background: PENDING, OK, ERRORE
+alter table issues add column if not exists image_status text;
+alter table issues add column if not exists image_error text;
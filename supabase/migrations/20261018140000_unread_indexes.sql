@@ -0,0 +1,4 @@
+-- Conteggi "da leggere" per i badge della sidebar: indici parziali piccoli
+create index if not exists material_requests_unread_idx on material_requests (id) where visto = 0;
+create index if not exists issues_unread_idx on issues (id) where visto = 0;
+create index if not exists logs_unread_idx on logs (id) where visto = 0;
@@ -0,0 +1,4 @@
+-- Posizione di riferimento del cantiere e raggio di tolleranza per le timbrature
+alter table cantieri add column if not exists lat double precision;
+alter table cantieri add column if not exists lon double precision;
+alter table cantieri add column if not exists raggio_m integer default 200;
@@ -0,0 +1,4 @@
+-- Id generato dall'app per ogni turno: le timbrature rinviate dalla coda locale
+-- non creano doppioni (upsert on conflict client_id)
+alter table logs add column if not exists client_id text;
+create unique index if not exists logs_client_id_key on logs (client_id);
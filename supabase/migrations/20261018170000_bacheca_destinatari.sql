@@ -0,0 +1,10 @@
+-- Destinatari come array indicizzato (GIN) al posto della stringa separata da virgole:
+-- la bacheca di un dipendente è una sola query "destinatari && {TUTTI,username}"
+alter table bacheca add column if not exists destinatari text[];
+update bacheca set destinatari = array(select trim(x) from unnest(string_to_array(destinatario, ',')) as x)
+where destinatari is null and destinatario is not null;
+create index if not exists bacheca_destinatari_idx on bacheca using gin (destinatari);
+create index if not exists bacheca_scadenza_pub_idx on bacheca (data_scadenza, data_pubblicazione desc);
+
+-- Annunci scaduti spostati qui dalla pulizia periodica dell'app
+create table if not exists bacheca_archivio (like bacheca including all);
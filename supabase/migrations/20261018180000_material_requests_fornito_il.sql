@@ -0,0 +1,3 @@
+-- Data di fornitura in colonna: l'archiviazione di più richieste è un solo
+-- update ... where id in (...) invece di riscrivere item_list riga per riga
+alter table material_requests add column if not exists fornito_il timestamp;